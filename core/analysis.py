@@ -0,0 +1,297 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+import blobprocessor
+from cache import LRUCache
+import unicodedata
+
+
+"""
+Module providing the analysis of the texts and queries: the chain of
+transformations which turns a blob of text into the terms of the index.
+"""
+
+
+# The settings of the analyzer of the indexes built before the analyzers were
+# introduced, which only lower cased the words, deleted the punctuation and
+# the stop words.
+SIMPLE_SETTINGS = {'fold': False, 'remove_stop_words': True, 'stem': False}
+
+
+class Analyzer(object):
+    """
+    Turn blobs of text into terms and their positions.
+
+    The blob is first split in lower cased words, stripped of punctuation,
+    see blobprocessor.tokenize(). Then, depending on the settings, each token
+    is folded: its accents and other diacritics are removed and compatibility
+    characters such as ligatures are decomposed, so that 'ecole' matches
+    u'\xe9cole'. The stop words are removed. And the token is stemmed with the
+    Porter stemmer, so that 'searches' and 'searching' are indexed as
+    'search'.
+
+    The same Analyzer must be used to index the pages and to analyze the
+    queries, so its settings are saved with the index. The term of each token
+    is memoized in an LRU cache: the frequencies of the tokens follow Zipf's
+    law, so a small cache spares most of the folding and stemming.
+    Usage:
+    analyzer = Analyzer()
+    terms_and_positions, word_count = analyzer.tokenize(u'Searching the web')
+    """
+    # Default number of tokens whose term is memoized.
+    CACHE_SIZE = 50000
+
+    def __init__(self, fold=True, remove_stop_words=True, stem=True,
+                cache_size=CACHE_SIZE):
+        self._fold = fold
+        self._remove_stop_words = remove_stop_words
+        self._stem = stem
+        self._stop_words = frozenset()
+        if remove_stop_words:
+            self._stop_words = blobprocessor.STOP_WORDS
+        self._stemmer = PorterStemmer()
+        self._cache = LRUCache(cache_size)
+
+    def to_json(self):
+        """Return the settings of the Analyzer as a json serializable dict."""
+        return {'fold': self._fold, 'remove_stop_words': self._remove_stop_words,
+                'stem': self._stem}
+
+    @staticmethod
+    def from_json(json):
+        """Build an Analyzer from the settings returned by to_json()."""
+        return Analyzer(json['fold'], json['remove_stop_words'], json['stem'])
+
+    def tokenize(self, blob, intern_tokens=False):
+        """
+        Return the list of the (term, position) tuples of blob, the position
+        being the index of the word of the term in blob.split(), and the
+        number of words of blob. A byte string blob is decoded from utf-8.
+
+        If intern_tokens is True, equal terms share the same string object.
+        """
+        if isinstance(blob, str):
+            blob = blob.decode('utf-8', 'replace')
+        tokens, word_count = blobprocessor.tokenize(blob, intern_tokens,
+                                                    self._stop_words)
+        if not (self._fold or self._stem):
+            return tokens, word_count
+
+        terms = []
+        append = terms.append
+        cache = self._cache
+        # The terms of the tokens of the blob, which spares the LRU cache
+        # operations for the tokens repeated in the blob.
+        blob_terms = {}
+        for token, position in tokens:
+            term = blob_terms.get(token)
+            if term is None:
+                term = cache.get(token)
+                if term is None:
+                    term = self._analyze_token(token)
+                    # The tokens without term are cached with an empty term.
+                    cache.put(token, term)
+                blob_terms[token] = term
+            if term:
+                append((term, position))
+        return terms, word_count
+
+    def make_terms(self, blob):
+        """Return the list of the terms of blob, for instance of a query."""
+        return [term for term, position in self.tokenize(blob)[0]]
+
+    def _analyze_token(self, token):
+        """Return the term of token, or an empty string if it has none."""
+        if self._fold:
+            token = fold(token)
+            if not token or token in self._stop_words:
+                return u''
+        if self._stem and token.isalpha():
+            token = self._stemmer.stem(token)
+        return token
+
+
+def fold(token):
+    """
+    Decompose the characters of token in their compatibility decomposition
+    (NFKD) and drop the combining marks, such as the accents. Return the
+    letters and digits left.
+    """
+    if not isinstance(token, unicode):
+        return token
+    decomposed = unicodedata.normalize('NFKD', token)
+    folded = u''.join(char for char in decomposed
+                    if not unicodedata.combining(char))
+    if not folded.isalnum():
+        folded = blobprocessor.clean_word(folded)
+    return folded
+
+
+class PorterStemmer(object):
+    """
+    The Porter stemming algorithm, as published in M.F. Porter, An algorithm
+    for suffix stripping, Program 14(3), 1980.
+
+    It strips the common english suffixes from lower cased words, in five
+    steps. A word is seen as [C](VC){m}[V], C being a sequence of consonants
+    and V a sequence of vowels, and most rules only apply when the measure m
+    of the stem left is large enough. Words which are not made of ascii
+    letters only are returned as is.
+    """
+    STEP_2_SUFFIXES = (('ational', 'ate'), ('tional', 'tion'), ('enci', 'ence'),
+            ('anci', 'ance'), ('izer', 'ize'), ('abli', 'able'), ('alli', 'al'),
+            ('entli', 'ent'), ('eli', 'e'), ('ousli', 'ous'), ('ization', 'ize'),
+            ('ation', 'ate'), ('ator', 'ate'), ('alism', 'al'),
+            ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous'),
+            ('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble'))
+    STEP_3_SUFFIXES = (('icate', 'ic'), ('ative', ''), ('alize', 'al'),
+            ('iciti', 'ic'), ('ical', 'ic'), ('ful', ''), ('ness', ''))
+    STEP_4_SUFFIXES = ('al', 'ance', 'ence', 'er', 'ic', 'able', 'ible', 'ant',
+            'ement', 'ment', 'ent', 'ion', 'ou', 'ism', 'ate', 'iti', 'ous',
+            'ive', 'ize')
+
+    def stem(self, word):
+        """Return the stem of the lower cased word."""
+        if len(word) <= 2:
+            return word
+        try:
+            word = str(word)
+        except UnicodeEncodeError:
+            return word
+        if not word.isalpha():
+            return word
+        word = self._step_1a(word)
+        word = self._step_1b(word)
+        word = self._step_1c(word)
+        word = self._replace_suffix(word, PorterStemmer.STEP_2_SUFFIXES, 0)
+        word = self._replace_suffix(word, PorterStemmer.STEP_3_SUFFIXES, 0)
+        word = self._step_4(word)
+        word = self._step_5(word)
+        return unicode(word)
+
+    def _is_consonant(self, word, i):
+        char = word[i]
+        if char in 'aeiou':
+            return False
+        if char == 'y':
+            return i == 0 or not self._is_consonant(word, i - 1)
+        return True
+
+    def _measure(self, stem):
+        """Return the number of VC sequences of stem."""
+        length = len(stem)
+        i = 0
+        while i < length and self._is_consonant(stem, i):
+            i += 1
+        measure = 0
+        while i < length:
+            while i < length and not self._is_consonant(stem, i):
+                i += 1
+            if i >= length:
+                break
+            while i < length and self._is_consonant(stem, i):
+                i += 1
+            measure += 1
+        return measure
+
+    def _has_vowel(self, stem):
+        for i in xrange(len(stem)):
+            if not self._is_consonant(stem, i):
+                return True
+        return False
+
+    def _ends_with_double_consonant(self, word):
+        return (len(word) >= 2 and word[-1] == word[-2] and
+                self._is_consonant(word, len(word) - 1))
+
+    def _ends_with_cvc(self, word):
+        """
+        Return True if word ends with a consonant, a vowel and a consonant
+        other than w, x or y, like 'hop' but not like 'snow'.
+        """
+        length = len(word)
+        return (length >= 3 and self._is_consonant(word, length - 3) and
+                not self._is_consonant(word, length - 2) and
+                self._is_consonant(word, length - 1) and word[-1] not in 'wxy')
+
+    def _replace_suffix(self, word, suffixes, min_measure):
+        """
+        Replace the first of the (suffix, replacement) suffixes which ends
+        word if the measure of the stem is greater than min_measure.
+        """
+        for suffix, replacement in suffixes:
+            if word.endswith(suffix):
+                stem = word[:-len(suffix)]
+                if self._measure(stem) > min_measure:
+                    return stem + replacement
+                return word
+        return word
+
+    def _step_1a(self, word):
+        if word.endswith('sses'):
+            return word[:-2]
+        if word.endswith('ies'):
+            return word[:-2]
+        if word.endswith('ss'):
+            return word
+        if word.endswith('s'):
+            return word[:-1]
+        return word
+
+    def _step_1b(self, word):
+        if word.endswith('eed'):
+            if self._measure(word[:-3]) > 0:
+                return word[:-1]
+            return word
+        for suffix in ('ed', 'ing'):
+            if word.endswith(suffix) and self._has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                break
+        else:
+            return word
+        if word.endswith('at') or word.endswith('bl') or word.endswith('iz'):
+            return word + 'e'
+        if self._ends_with_double_consonant(word) and word[-1] not in 'lsz':
+            return word[:-1]
+        if self._measure(word) == 1 and self._ends_with_cvc(word):
+            return word + 'e'
+        return word
+
+    def _step_1c(self, word):
+        if word.endswith('y') and self._has_vowel(word[:-1]):
+            return word[:-1] + 'i'
+        return word
+
+    def _step_4(self, word):
+        for suffix in PorterStemmer.STEP_4_SUFFIXES:
+            if word.endswith(suffix):
+                stem = word[:-len(suffix)]
+                if self._measure(stem) > 1 and (suffix != 'ion' or
+                                                stem[-1:] in ('s', 't')):
+                    return stem
+                return word
+        return word
+
+    def _step_5(self, word):
+        if word.endswith('e'):
+            stem = word[:-1]
+            measure = self._measure(stem)
+            if measure > 1 or (measure == 1 and not self._ends_with_cvc(stem)):
+                word = stem
+        if (word.endswith('ll') and self._measure(word) > 1):
+            word = word[:-1]
+        return word
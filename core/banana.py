@@ -15,10 +15,16 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from analysis import Analyzer, SIMPLE_SETTINGS
+import builder
 from crawler import Crawler
+from frontier import Frontier
 from index import Index
+import itertools
 import logging
-from searcher import Searcher
+from pipeline import Pipeline
+from searcher import SharedSearcher
+import segment
 
 
 class Banana(object):
@@ -52,7 +58,13 @@ class Banana(object):
             # Get the logger.
             self._logger = logging.getLogger(__name__)
 
-        def crawl(self, restart, seed=None):
+            # The searcher is shared by all the searches, the index is loaded at
+            # the first search and reloaded only when a new one is dumped.
+            self._searcher = SharedSearcher()
+
+        def crawl(self, restart, seed=None, thread_count=1,
+                timeout=Crawler.TIMEOUT, delay=Frontier.DELAY,
+                seen_error_rate=0.0001, exact_seen=False, process_count=0):
             """
             Crawl the web starting from the seed url and using a potentially already
             dumped list of urls to crawl.
@@ -60,28 +72,105 @@ class Banana(object):
             A seed url is optional when restarting a crawl session, however, when
             setting up a new crawling session (restart being False), a seed url is
             mandatory.
+
+            thread_count pages are fetched concurrently, each fetch timing out
+            after timeout seconds, and each host is fetched at most once every
+            delay seconds. A never seen url is wrongly skipped as already seen
+            with a probability of seen_error_rate, unless exact_seen is True.
+
+            If process_count is not 0, the pages are parsed and tokenized by a
+            pipeline.Pipeline of process_count processes, while this process
+            only adds them to the index.
             """
             # Build a Crawler that will start crawling from the seed.
-            crawler = Crawler(restart, seed)
+            crawler = Crawler(restart, seed, thread_count, timeout, delay,
+                            seen_error_rate, exact_seen)
 
             # Build an Index. If restart is True, this will append data to the
             # existing index in the current directory.
             index = Index(restart)
+
+            # The pipeline tokenizes the pages like the index does.
+            pipeline = None
+            if process_count:
+                pipeline = Pipeline(index.get_analyzer(), process_count)
+            pages = crawler.crawl_pages(pipeline)
             try:
-                for i in xrange(1000): # ================================
-                    page = crawler.crawl()
-                    index.add_entry(page)
-            except StopIteration:
-                pass
+                for page in itertools.islice(pages, 1000): # ================================
+                    if pipeline:
+                        index.add_tokenized_page(page)
+                    else:
+                        index.add_entry(page)
+            finally:
+                # Stop the fetches in progress.
+                pages.close()
+                if pipeline:
+                    pipeline.close()
+                # Write the pages of the session to the index snapshot.
+                index.close()
+
+        def use_index(self, index_filename=None,
+                    cache_size=SharedSearcher.CACHE_SIZE,
+                    cache_ttl=SharedSearcher.CACHE_TTL):
+            """
+            Search in the index dumped to 'index_filename', either a json
+            index or a segment directory, instead of the default index.json.
+
+            The answers are cached in cache_size bytes for cache_ttl seconds,
+            see searcher.SharedSearcher.
+            """
+            self._searcher = SharedSearcher(index_filename or Index.FILENAME,
+                                            cache_size, cache_ttl)
+
+        def load_index(self):
+            """
+            Load the index now, if it exists, rather than at the first search.
+            """
+            self._searcher.load()
 
-        def search(self, query):
+        def convert(self, json_filename, segment_dirname):
+            """
+            Convert the json index 'json_filename' to the segment directory
+            'segment_dirname'.
+            """
+            segment.convert(json_filename, segment_dirname)
+
+        def reindex(self, input_filename, segment_dirname, process_count=None,
+                    flush_count=builder.FLUSH_COUNT, simple_analyzer=False):
+            """
+            Index again the pages stored in 'input_filename', a json index, an
+            index log or a segment, in the segment directory 'segment_dirname',
+            with process_count processes or one per core.
+
+            The pages are folded, stemmed and stripped of their stop words,
+            unless simple_analyzer is True, in which case they are only
+            stripped of their stop words.
+            """
+            analyzer = None
+            if simple_analyzer:
+                analyzer = Analyzer.from_json(SIMPLE_SETTINGS)
+            builder.build_segment(input_filename, segment_dirname, process_count,
+                                flush_count, analyzer=analyzer)
+
+        def search(self, query, limit=10, offset=0, snippets=True):
             """
             Search in the index for answer to query and return a list of relevant
-            urls.
+            urls, the limit best ones after skipping the offset first ones.
+            Without snippets, the answers have no snippet.
             """
             self._logger.info('query: ' + query)
-            searcher = Searcher()
-            return searcher.query(query)
+            return self._searcher.query(query, limit, offset, snippets)
+
+        def get_index_generation(self):
+            """
+            Return the generation of the index searched, which changes each
+            time a new index is dumped.
+            """
+            return self._searcher.get_generation()
+
+        def get_search_stats(self):
+            """Return the dict of the statistics of the searches."""
+            return self._searcher.get_stats()
 
     # The instance reference.
     __instance = None
@@ -30,39 +30,60 @@ STOP_WORDS = set([
         't', 'that', 'the', 'their', 'then', 'there', 'these',
         'they', 'this', 'to', 'was', 'will', 'with'
         ])
-PUNCTUATION_PATTERN = re.compile(r'[-~`!@#$%^&*()+={}\[\]|\\:;"\',<.>/?]')
-VALID_WORD_PATTERN = re.compile(r'^[a-zA-Z]+$')
+# The punctuation characters deleted from the words.
+PUNCTUATION = '-~`!@#$%^&*()+={}[]|\\:;"\',<.>/?'
+PUNCTUATION_PATTERN = re.compile('[' + re.escape(PUNCTUATION) + ']+')
+# The characters other than letters and digits, deleted from the words which
+# still contain some once the punctuation is deleted.
+NON_WORD_CHARS_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
 MULTIPLE_SPACES_PATTERN = re.compile(r'\s{2,}')
 MEANINGLESS_CHARS_PATTERN = re.compile(r'[\t\n\r\f\v]')
 
-def make_tokens_and_position(blob):
+
+def tokenize(blob, intern_tokens=False, stop_words=STOP_WORDS):
+    """
+    From a given Unicode blob of text, return the list of tuples containing
+    the preprocessed tokens and their position in the blob, and the number of
+    words of the blob, in a single pass over the blob. See iter_tokens().
     """
-    From a given Unicode blob of text, return the corresponding list of
-    tuples containing the preprocessed tokens and their position in the
-    original blob.
+    words = blob.lower().split()
+    return list(iter_tokens(words, intern_tokens, stop_words)), len(words)
+
 
-    To do that, lower case the blob, strip punctuation, split by words, get
-    rid of stop words, validate that each obtained word matches the
-    Indexer.VALID_WORD_PATTERN regular expression.
+def iter_tokens(words, intern_tokens=False, stop_words=STOP_WORDS):
     """
-    tokens = []
-    for position, token in enumerate(blob.lower().split()):
-        # Remove punctuation.
-        token = PUNCTUATION_PATTERN.sub(' ', token)
-        if not token in STOP_WORDS:
-            tokens.append((token.strip(), position))
-    return tokens
+    Generate the (token, position) tuples of words, the lower cased words of
+    a blob, the position of a token being the index of its word in words.
 
+    Each word has its punctuation and its other characters which are neither
+    letters nor digits deleted, then the stop_words and the words left empty
+    are skipped.
 
-def make_tokens(blob):
+    If intern_tokens is True, the equal tokens share the same string object,
+    which makes a list of them smaller to keep or to pickle.
     """
-    From a given Unicode blob of text, return the corresponding list of tokens.
+    intern_token = {}.setdefault if intern_tokens else None
+    for position, token in enumerate(words):
+        # Most words are made of letters and digits only and are their own
+        # token.
+        if not token.isalnum():
+            token = clean_word(token)
+            if not token:
+                continue
+        if token not in stop_words:
+            yield (intern_token(token, token) if intern_token else token), position
 
-    To do that, lower case the blob, strip punctuation, split by words, get
-    rid of stop words, validate that each obtained word matches the
-    Indexer.VALID_WORD_PATTERN regular expression.
+
+def clean_word(word):
+    """
+    Delete the punctuation and the other characters which are neither letters
+    nor digits from the word.
     """
-    return zip(*make_tokens_and_position(blob))[0]
+    word = PUNCTUATION_PATTERN.sub(u'', word)
+    if not word.isalnum():
+        # Rare words with symbols other than the usual punctuation.
+        word = NON_WORD_CHARS_PATTERN.sub(u'', word)
+    return word
 
 
 def remove_meaningless_chars(blob):
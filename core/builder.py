@@ -0,0 +1,315 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from analysis import Analyzer
+from array import array
+from docstore import DocumentStore
+import heapq
+from index import Index, InvertedIndex
+import itertools
+import json
+import logging
+import multiprocessing
+from operator import itemgetter
+import os
+from pipeline import TokenizedPage
+import segment
+import shutil
+import signal
+import traceback
+
+
+"""
+Module providing the offline build of an index segment from stored pages,
+with several processes.
+
+The pages are numbered and dealt in batches to worker processes. Each worker
+tokenizes its pages and indexes them in memory, in a pair of
+index.InvertedIndex. Whenever they hold more than a given number of token
+occurrences, the worker writes them to a run, a partial segment holding
+only the term dictionaries and the postings of its pages, and starts over
+with empty ones (the SPIMI algorithm). The main process writes the
+documents of the segment in the order of their ids as the workers return
+them. Once all the pages are indexed, it merges the terms of all the runs
+with a k-way merge into the final segment.
+
+So the memory of a worker is bounded by its flush count, and the merge only
+holds the postings of one term at a time.
+"""
+
+
+# Default number of token occurrences a worker indexes in memory before
+# writing them to a run.
+FLUSH_COUNT = 2000000
+# Number of pages in each batch sent to a worker.
+BATCH_SIZE = 100
+
+
+def iter_stored_pages(filename):
+    """
+    Iterate on the (url, title, text, date) tuples of the pages stored in
+    'filename', which is either a segment directory, an index log such as
+    index.json.log, holding one json page per line, or a json index. A json
+    index is loaded in memory as a whole, the others are read as they are
+    iterated.
+    """
+    if os.path.isdir(filename):
+        with open(os.path.join(filename, 'meta.json')) as fp:
+            format_version = json.load(fp)['format_version']
+        documents = segment.Documents(filename, format_version)
+        for doc_id in xrange(documents.get_count()):
+            document = documents.get(doc_id)
+            yield (document['url'], document['title'],
+                    documents.get_full_text(doc_id), document['date'])
+    elif filename.endswith('.log'):
+        for page in _iter_log_pages(filename):
+            yield page
+    else:
+        index = Index(True, filename, read_only=True)
+        for doc_id, url, url_info in index.iter_documents():
+            yield (url, url_info['title'], index.get_full_text(doc_id),
+                    url_info['date'])
+
+
+def _iter_log_pages(filename):
+    """
+    Iterate on the pages of the index log 'filename'. As when the log is
+    replayed in an Index, a page logged several times is only indexed in its
+    last version. The texts are read from the docstore.DocumentStore of the
+    index, unless they were logged before the texts were stored apart.
+    """
+    logger = logging.getLogger(__name__)
+    # First find the line of the last version of each page.
+    last_lines = {}
+    with open(filename) as fp:
+        for line_number, line in enumerate(fp):
+            try:
+                last_lines[json.loads(line)['url']] = line_number
+            except ValueError:
+                logger.warning('Skipping a truncated record in the index log '
+                        '\'%s\'.' % filename)
+    store = DocumentStore(filename[:-len('.log')] + '.texts', read_only=True)
+    with open(filename) as fp:
+        for line_number, line in enumerate(fp):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if last_lines[record['url']] == line_number:
+                text = record.get('text')
+                if text is None:
+                    text = store.get(record['text_offset'], record['text_size'])
+                yield record['url'], record['title'], text, record['date']
+
+
+def build_segment(input_filename, dirname, process_count=None,
+                flush_count=FLUSH_COUNT, batch_size=BATCH_SIZE, analyzer=None):
+    """
+    Index the pages stored in 'input_filename', see iter_stored_pages(), in
+    the segment 'dirname' with process_count worker processes, or as many as
+    there are cores if it is None. Each worker writes a run every flush_count
+    token occurrences.
+
+    The pages are analyzed with analyzer, an analysis.Analyzer, or with a
+    default Analyzer if it is None, whatever the analyzer they were stored
+    with.
+    """
+    logger = logging.getLogger(__name__)
+    if process_count is None:
+        process_count = multiprocessing.cpu_count()
+    if analyzer is None:
+        analyzer = Analyzer()
+    logger.info('Building the index segment \'%s\' from \'%s\' with %d '
+            'processes.' % (dirname, input_filename, process_count))
+
+    runs_dirname = dirname + '.runs'
+    if os.path.exists(runs_dirname):
+        shutil.rmtree(runs_dirname)
+    os.makedirs(runs_dirname)
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = []
+    for worker_number in xrange(process_count):
+        worker = multiprocessing.Process(target=_run_worker,
+                args=(worker_number, runs_dirname, flush_count,
+                    analyzer.to_json(), tasks, results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    try:
+        writer = segment.SegmentWriter(dirname)
+        title_lengths = array('I')
+        full_text_lengths = array('I')
+        run_dirnames = []
+
+        pages = enumerate(iter_stored_pages(input_filename))
+        submitted_count = 0
+        written_count = 0
+        finished_count = 0
+        # The documents of the batches returned out of order, by batch number.
+        pending_documents = {}
+        is_exhausted = False
+        while not is_exhausted or written_count < submitted_count or finished_count < process_count:
+            # Keep two batches per worker in flight, at most.
+            while not is_exhausted and submitted_count - written_count < 2 * process_count:
+                batch = [(doc_id, url, title, text, date) for doc_id, (url, title, text, date)
+                        in itertools.islice(pages, batch_size)]
+                if not batch:
+                    is_exhausted = True
+                    for worker in workers:
+                        tasks.put(None)
+                    break
+                tasks.put((submitted_count, batch))
+                submitted_count += 1
+
+            message = results.get()
+            if message[0] == 'error':
+                raise Exception('A worker failed to build its runs:\n%s' % message[1])
+            elif message[0] == 'runs':
+                run_dirnames.extend(message[1])
+                finished_count += 1
+            else:
+                pending_documents[message[1]] = message[2]
+                while written_count in pending_documents:
+                    for document, full_text in pending_documents.pop(written_count):
+                        writer.add_document(document, full_text)
+                        title_lengths.append(document['title_length'])
+                        full_text_lengths.append(document['full_text_length'])
+                    written_count += 1
+        for worker in workers:
+            worker.join()
+
+        logger.info('Merging %d runs.' % len(run_dirnames))
+        for field, lengths in zip(segment.FIELDS, (title_lengths, full_text_lengths)):
+            field_writer = writer.make_field_writer(field)
+            field_writer.write_lengths(lengths)
+            runs = [segment.SegmentInvertedIndex(run_dirname, field)
+                    for run_dirname in run_dirnames]
+            for term, postings in merge_terms(runs):
+                field_writer.add_term(term, postings)
+            field_writer.close()
+
+        writer.close({'analyzer': analyzer.to_json(),
+                'average_title_length': _get_average(title_lengths),
+                'average_full_text_length': _get_average(full_text_lengths)})
+        logger.info('A total of %d urls were written.' % len(title_lengths))
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        shutil.rmtree(runs_dirname)
+
+
+def merge_terms(inverted_indexes):
+    """
+    Merge the terms of inverted_indexes, which index disjoint sets of
+    documents, for instance the runs of build_segment(). Iterate on the
+    (term, postings) pairs in the lexicographic order of the terms, postings
+    being the list of the (doc_id, positions) of the term in all the inverted
+    indexes, by increasing doc id.
+    """
+    terms = heapq.merge(*[_iter_numbered_terms(inverted_index, number)
+                        for number, inverted_index in enumerate(inverted_indexes)])
+    for term, group in itertools.groupby(terms, itemgetter(0)):
+        posting_lists = [numbered_term[2] for numbered_term in group]
+        if len(posting_lists) == 1:
+            yield term, list(posting_lists[0].iter_postings())
+        else:
+            yield term, list(heapq.merge(*[posting_list.iter_postings()
+                                        for posting_list in posting_lists]))
+
+
+def _iter_numbered_terms(inverted_index, number):
+    """
+    Iterate on the (term, number, PostingList) of inverted_index, the number
+    breaking the ties between the inverted indexes in merge_terms().
+    """
+    for term, posting_list in inverted_index.iter_terms():
+        yield term, number, posting_list
+
+
+def _get_average(lengths):
+    if not lengths:
+        return 0.0
+    return float(sum(lengths)) / len(lengths)
+
+
+def _run_worker(worker_number, runs_dirname, flush_count, analyzer_settings,
+                tasks, results):
+    """
+    Main function of a worker process of build_segment().
+
+    Tokenize with an analysis.Analyzer of analyzer_settings and index the
+    batches of pages read from tasks, until None is read, and put back in
+    results the documents of each batch to be written to the segment. Then
+    put the list of the runs written.
+    """
+    # Let the main process alone handle the interruptions.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        analyzer = Analyzer.from_json(analyzer_settings)
+        run_dirnames = []
+        title_index = InvertedIndex()
+        full_text_index = InvertedIndex()
+        occurrence_count = 0
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            batch_number, batch = task
+            documents = []
+            for doc_id, url, title, text, date in batch:
+                page = TokenizedPage(url, title, text, analyzer)
+                title_index.add_entries(doc_id, page.title_tokens)
+                full_text_index.add_entries(doc_id, page.text_tokens)
+                occurrence_count += len(page.title_tokens) + len(page.text_tokens)
+                documents.append(({'url': url,
+                        'title': page.title,
+                        'date': date,
+                        'title_length': page.title_length,
+                        'full_text_length': page.text_length}, page.text))
+            results.put(('documents', batch_number, documents))
+
+            if occurrence_count >= flush_count:
+                run_dirnames.append(_write_run(runs_dirname, worker_number,
+                        len(run_dirnames), title_index, full_text_index))
+                title_index = InvertedIndex()
+                full_text_index = InvertedIndex()
+                occurrence_count = 0
+        if occurrence_count:
+            run_dirnames.append(_write_run(runs_dirname, worker_number,
+                    len(run_dirnames), title_index, full_text_index))
+        results.put(('runs', run_dirnames))
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+def _write_run(runs_dirname, worker_number, run_number, title_index,
+                full_text_index):
+    """
+    Write the terms of title_index and full_text_index to a new run in
+    'runs_dirname' and return the name of its directory.
+    """
+    run_dirname = os.path.join(runs_dirname, '%d-%d' % (worker_number, run_number))
+    os.makedirs(run_dirname)
+    for field, inverted_index in zip(segment.FIELDS, (title_index, full_text_index)):
+        field_writer = segment.FieldWriter(run_dirname, field)
+        for term, posting_list in inverted_index.iter_terms():
+            field_writer.add_term(term, list(posting_list.iter_postings()))
+        field_writer.close()
+    return run_dirname
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+import time
+
+
+"""
+Module providing the in-memory caches of banana.
+"""
+
+
+class LRUCache(object):
+    """
+    Mapping holding items of a total size of at most capacity: when it is
+    full, adding an item evicts the least recently used ones. The size of an
+    item is given when it is added, 1 by default, in which case capacity is a
+    number of items. With a ttl, the items expire ttl seconds after being
+    added.
+
+    The items are kept in a circular doubly linked list, from the least to the
+    most recently used, whose links are [previous, next, key, value, size,
+    date] lists, and a dict maps the keys to their links. All the operations
+    take constant time and are thread safe. The cache counts its hits,
+    misses, evictions and expirations, see get_stats().
+    Usage:
+    cache = LRUCache(1000)
+    cache.put('searching', 'search')
+    cache.get('searching')
+    """
+    def __init__(self, capacity, ttl=None):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._links = {}
+        # The sentinel link of the list, root[1] is the least recently used
+        # link and root[0] the most recently used one.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0, None]
+        self._size = 0
+        self._hit_count = 0
+        self._miss_count = 0
+        self._eviction_count = 0
+        self._expiration_count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def get(self, key, default=None):
+        """
+        Return the value of key and mark it as the most recently used item,
+        or return default if key is not in the cache or has expired.
+        """
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None and self._ttl is not None and \
+                    time.time() - link[5] > self._ttl:
+                self._remove(link)
+                self._expiration_count += 1
+                link = None
+            if link is None:
+                self._miss_count += 1
+                return default
+            self._hit_count += 1
+            self._move_to_end(link)
+            return link[3]
+
+    def put(self, key, value, size=1):
+        """
+        Add or replace the item of key, as the most recently used one. An item
+        larger than the capacity is not kept.
+        """
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                self._remove(link)
+            if size > self._capacity:
+                return
+            while self._size + size > self._capacity:
+                # Evict the least recently used links.
+                self._remove(self._root[1])
+                self._eviction_count += 1
+            self._append(key, value, size)
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None, None, 0, None]
+            self._size = 0
+
+    def get_stats(self):
+        """
+        Return a dict of the statistics of the cache: its numbers of items,
+        hits, misses, evictions and expirations, its size and its capacity.
+        """
+        with self._lock:
+            return {'count': len(self._links),
+                    'hits': self._hit_count,
+                    'misses': self._miss_count,
+                    'evictions': self._eviction_count,
+                    'expirations': self._expiration_count,
+                    'size': self._size,
+                    'capacity': self._capacity}
+
+    def _append(self, key, value, size):
+        """Add the item of key as the most recently used one."""
+        root = self._root
+        last = root[0]
+        date = time.time() if self._ttl is not None else None
+        link = [last, root, key, value, size, date]
+        last[1] = root[0] = self._links[key] = link
+        self._size += size
+
+    def _remove(self, link):
+        del self._links[link[2]]
+        self._unlink(link)
+        self._size -= link[4]
+
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def _move_to_end(self, link):
+        self._unlink(link)
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+
+class TinyLFUCache(LRUCache):
+    """
+    LRUCache which only admits a new item if it is more frequently asked for
+    than the items it would evict.
+
+    The frequencies of the keys asked for, cached or not, are estimated by a
+    FrequencySketch. When the cache is full, a new item is added only if its
+    key was asked for more often than the key of each least recently used
+    item which must be evicted to make room for it, otherwise it is
+    rejected. So a burst of keys asked for once, such as the rare terms of
+    the queries, cannot flush the frequently asked ones. This is the TinyLFU
+    admission policy, the frequencies fading over time so that the cache
+    follows the changes of popularity.
+    """
+    # Default number of counters of each row of the sketch.
+    SKETCH_WIDTH = 1 << 16
+
+    def __init__(self, capacity, sketch_width=SKETCH_WIDTH):
+        LRUCache.__init__(self, capacity)
+        self._sketch = FrequencySketch(sketch_width)
+        self._rejection_count = 0
+
+    def get(self, key, default=None):
+        self._sketch.add(key)
+        return LRUCache.get(self, key, default)
+
+    def put(self, key, value, size=1):
+        """
+        Add or replace the item of key, as the most recently used one, unless
+        the items to evict for it are asked for as often as it is.
+        """
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                self._remove(link)
+            if size > self._capacity:
+                return
+            frequency = self._sketch.estimate(key)
+            free_size = self._capacity - self._size
+            victims = []
+            victim = self._root[1]
+            while free_size < size:
+                if self._sketch.estimate(victim[2]) >= frequency:
+                    self._rejection_count += 1
+                    return
+                victims.append(victim)
+                free_size += victim[4]
+                victim = victim[1]
+            for victim in victims:
+                self._remove(victim)
+                self._eviction_count += 1
+            self._append(key, value, size)
+
+    def get_stats(self):
+        """See LRUCache.get_stats(), with the number of rejected items."""
+        stats = LRUCache.get_stats(self)
+        stats['rejections'] = self._rejection_count
+        return stats
+
+
+class FrequencySketch(object):
+    """
+    Count-min sketch estimating how many times keys were added recently, in
+    a fixed amount of memory.
+
+    Each key is counted in one counter of each of the DEPTH rows of width
+    counters, chosen by hashing the key, and its estimate is the lowest of
+    these counters, which may only overestimate it when other keys share all
+    its counters. The counters are capped at MAX_COUNT, and all are halved
+    every sample_size additions, so that the old additions fade away.
+    """
+    DEPTH = 4
+    MAX_COUNT = 15
+    # Seeds of the hashes of the rows.
+    SEEDS = (0x9e3779b97f4a7c15, 0xbf58476d1ce4e5b9, 0x94d049bb133111eb,
+            0xd6e8feb86659fd93)
+    # Translation table halving the counters.
+    _HALVING_TABLE = ''.join(chr(count >> 1) for count in xrange(256))
+
+    def __init__(self, width, sample_size=None):
+        """
+        width is rounded up to a power of two, and sample_size defaults to
+        ten times width.
+        """
+        self._width = 1
+        while self._width < width:
+            self._width *= 2
+        self._sample_size = sample_size or 10 * self._width
+        self._table = bytearray(FrequencySketch.DEPTH * self._width)
+        self._addition_count = 0
+
+    def _get_indexes(self, key):
+        """Return the indexes of the counters of key in the table."""
+        mask = self._width - 1
+        key_hash = hash(key) & 0xffffffffffffffff
+        return [row * self._width + (((key_hash ^ seed) * 0x2545f4914f6cdd1d >> 32) & mask)
+                for row, seed in enumerate(FrequencySketch.SEEDS)]
+
+    def add(self, key):
+        table = self._table
+        for index in self._get_indexes(key):
+            if table[index] < FrequencySketch.MAX_COUNT:
+                table[index] += 1
+        self._addition_count += 1
+        if self._addition_count >= self._sample_size:
+            self._table = table.translate(FrequencySketch._HALVING_TABLE)
+            self._addition_count //= 2
+
+    def estimate(self, key):
+        table = self._table
+        return min(table[index] for index in self._get_indexes(key))
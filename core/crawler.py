@@ -15,9 +15,14 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from fetcher import Fetcher
+from frontier import Frontier
 from htmlutils import HTMLPage
 import json
 import logging
+import Queue
+from seenfilter import SeenUrls
+import time
 import unicodedata
 import urllib2
 
@@ -38,8 +43,13 @@ class Crawler(object):
     # Filename of the file to which the url to crawl will be dumped at the end
     # of the crawling session and read from at the next restart session.
     FILENAME = 'crawler.json'
+    # Filename of the file to which the urls seen by the crawler are dumped.
+    SEEN_FILENAME = 'crawler.seen'
+    # Default timeout in seconds of the network operations of a fetch.
+    TIMEOUT = 10
 
-    def __init__(self, restart, seed=None):
+    def __init__(self, restart, seed=None, thread_count=1, timeout=TIMEOUT,
+                delay=Frontier.DELAY, seen_error_rate=0.0001, exact_seen=False):
         """
         Build a Crawler that will start crawling the web from the seed url and
         using a potentially already dumped list of urls to crawl.
@@ -47,6 +57,16 @@ class Crawler(object):
         A seed url is optionnal when restarting a crawl session, however, when
         setting up a new crawling session (restart being False), a seed url is
         mandatory.
+
+        thread_count is the number of pages fetched concurrently by
+        crawl_pages() and timeout the timeout in seconds of each fetch. delay
+        is the minimum delay in seconds between two fetches from the same
+        host.
+
+        Each url found is crawled once, the urls already seen being recorded
+        in a seenfilter.SeenUrls. seen_error_rate is the probability that an
+        url never seen is wrongly skipped as seen, unless exact_seen is True,
+        in which case the seen urls are also stored exactly on the disk.
         """
         # Get a logger assuming that the logging facility has been set up by the
         # banana module.
@@ -58,20 +78,29 @@ class Crawler(object):
 
         # Set up the members.
         self._seed = None
-        self._tocrawl = set([])
-        self._crawled = set([])
+        self._tocrawl = Frontier(delay)
+        # The urls crawled or queued to be crawled.
+        self._seen = SeenUrls(Crawler.SEEN_FILENAME, restart, seen_error_rate,
+                            exact_seen)
+        self._thread_count = thread_count
+        self._timeout = timeout
 
         if seed:
             if not self.is_url_valid(seed):
                 raise Exception('The given seed url is not valid in the '
                                 'constructor of the Crawler.')
             self._seed = seed
+            if self._seen.add(seed):
+                self._tocrawl.add(seed, 0)
         if restart:
             with open(Crawler.FILENAME) as fp:
-                urls_to_crawl = json.load(fp)
-                for url in urls_to_crawl:
-                    self._tocrawl.add(url)
-            self._logger.debug('Urls to crawl:\n' + str(self._tocrawl))
+                tocrawl = json.load(fp)
+            self._tocrawl.load_json(tocrawl)
+            # The urls to crawl dumped before the seen urls were persisted are
+            # not in the seen urls yet.
+            for item in tocrawl:
+                self._seen.add(item if isinstance(item, basestring) else item[0])
+            self._logger.debug('Urls to crawl:\n' + str(self._tocrawl.to_json()))
 
     def __del__(self):
         self._logger.debug('Deleting Crawler, dumping the urls to crawl.')
@@ -82,7 +111,8 @@ class Crawler(object):
         try:
             self._logger.info('There are %d urls to crawl.' % len(self._tocrawl))
             with open(filename, 'w') as fp:
-                json.dump(list(self._tocrawl), fp)
+                json.dump(self._tocrawl.to_json(), fp)
+            self._seen.dump()
         except Exception as e:
             self._logger.warning(e)
             self._logger.warning('The Crawler seems to be malformed. '
@@ -98,12 +128,11 @@ class Crawler(object):
             self.crawl()
             crawl_counter += 1
 
-        # End of crawling, log crawled urls.
-        with open('crawled','w') as fp:
-            for url in self._crawled:
-                fp.write(url + '\n')
+        # End of crawling, log the urls to crawl. The seen urls cannot be
+        # listed, only counted.
+        self._logger.info('%d urls seen.' % len(self._seen))
         with open('tocrawl','w') as fp:
-            for url in self._tocrawl:
+            for url, depth in self._tocrawl.to_json():
                 fp.write(url + '\n')
 
     def crawl(self):
@@ -112,41 +141,33 @@ class Crawler(object):
         htmlutils.HTMLPage object.
         """
         try:
-            # If this is the first link to crawl of the session and if a seed
-            # url is present, use the seed url.
+            # Wait for the next url that may be crawled.
             crawling = None
-            if not self._crawled and self._seed:
-                crawling = self._seed
-            else:
-                crawling = self._tocrawl.pop()
-
-            # DEBUG security check.
-            if crawling in self._crawled:
-                raise Exception("The crawling url %s was already crawled during this session!" % crawling)
+            while True:
+                next_url = self._next_url()
+                if next_url:
+                    crawling, depth = next_url
+                    break
+                wait_time = self._tocrawl.get_wait_time()
+                if wait_time is None:
+                    # Same as the former set based _tocrawl.pop().
+                    raise KeyError('pop from an empty Frontier')
+                time.sleep(wait_time)
 
             self._logger.info(crawling)
-            if not self.is_url_valid(crawling):
-                # Call recursively this method to crawl the next available url.
-                self._logger.info('skipping url %s' % crawling)
-                return self.crawl()
 
-            # Read the page to a byte string, convert it to unicode and retrieve
-            # the relevant information of the web page.
-            html = urllib2.urlopen(crawling).read().decode('utf-8', 'replace')
-            page = HTMLPage(crawling, html)
+            # Read the page chunk by chunk, and retrieve the relevant information
+            # of the web page while it is read.
+            try:
+                page = HTMLPage.from_stream(crawling,
+                        urllib2.urlopen(crawling, timeout=self._timeout))
+            finally:
+                self._tocrawl.done(crawling)
 
             if page.title:
                 self._logger.info(page.title)
 
-            # Add the current url to the already crawled url's list.
-            self._crawled.add(crawling)
-
-            # Retrieve the external links on the page and add them
-            # to the urls to crawl if they weren't already crawled.
-            for link in page.links:
-                if not link in self._crawled and self.is_url_valid(link):
-                    self._tocrawl.add(link)
-
+            self._add_links(page, depth + 1)
             return page
 
         except urllib2.HTTPError as e:
@@ -167,6 +188,101 @@ class Crawler(object):
             raise
             return self.crawl()
 
+    def crawl_pages(self, pipeline=None):
+        """
+        Crawl the links to crawl with thread_count concurrent fetches and
+        generate the crawled pages as htmlutils.HTMLPage objects, until there
+        are no more links to crawl.
+
+        If pipeline, a pipeline.Pipeline, is given, the pages are parsed and
+        tokenized by its processes, and generated as pipeline.TokenizedPage
+        objects.
+
+        The pages are generated in the order in which their fetches complete.
+        The urls are taken from the Frontier, which lets each host be fetched
+        by one thread at a time. If the generator is closed before the end,
+        the urls being fetched are put back in the urls to crawl.
+        """
+        fetcher = Fetcher(self._thread_count, self._timeout, pipeline)
+        # Depths of the urls submitted to the fetcher and not fetched yet. Keep
+        # twice as many urls as threads in flight so that the threads never
+        # wait for urls.
+        in_flight = {}
+        max_in_flight = 2 * self._thread_count
+        try:
+            while True:
+                while len(in_flight) < max_in_flight:
+                    next_url = self._next_url()
+                    if next_url is None:
+                        break
+                    crawling, depth = next_url
+                    in_flight[crawling] = depth
+                    fetcher.submit(crawling)
+
+                wait_time = self._tocrawl.get_wait_time()
+                if not in_flight:
+                    if wait_time is None:
+                        self._logger.info('Reached the end of the web.')
+                        return
+                    # All the hosts to crawl were fetched too recently.
+                    time.sleep(wait_time)
+                    continue
+
+                # Wait for a fetch to complete, or for a host to become ready
+                # to be fetched again.
+                try:
+                    crawling, page, error = fetcher.get_result(wait_time)
+                except Queue.Empty:
+                    continue
+                depth = in_flight.pop(crawling)
+                self._tocrawl.done(crawling)
+                if error:
+                    self._logger.warning('Unable to crawl url %s: %s' % (crawling, error))
+                    continue
+
+                self._logger.info(crawling)
+                if page.url != crawling:
+                    # The url was redirected, the page it led to is crawled
+                    # now and must not be fetched again.
+                    self._logger.info('Redirected to %s' % page.url)
+                    self._seen.add(page.url)
+                if page.title:
+                    self._logger.info(page.title)
+                self._add_links(page, depth + 1)
+                yield page
+        finally:
+            fetcher.close()
+            # The urls being fetched are still in the seen urls, which cannot
+            # forget them, and are crawled again from the urls to crawl.
+            for url, depth in in_flight.iteritems():
+                self._tocrawl.done(url, delay=0)
+                self._tocrawl.add(url, depth)
+
+    def _add_links(self, page, depth):
+        """
+        Queue the valid links of page which were never seen before, found at
+        depth links from the seed url.
+        """
+        for link in page.links:
+            if self.is_url_valid(link) and self._seen.add(link):
+                self._tocrawl.add(link, depth)
+
+    def _next_url(self):
+        """
+        Pop the (url, depth) tuple of the next valid url which may be crawled
+        now, or return None if there is none.
+        """
+        while True:
+            next_url = self._tocrawl.pop()
+            if next_url is None:
+                return None
+            url = next_url[0]
+            if not self.is_url_valid(url):
+                self._logger.info('skipping url %s' % url)
+                self._tocrawl.done(url, delay=0)
+                continue
+            return next_url
+
     def is_url_valid(self, url):
         """
         Check if the given url string does not contains prohibited fragments.
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from array import array
+from cache import LRUCache
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+
+
+"""
+Module providing the storage of the full texts of the documents, apart from
+the index.
+"""
+
+
+# The words of a text are its runs of non space characters, as split by
+# unicode.split().
+WORD_PATTERN = re.compile(r'\S+', re.UNICODE)
+# Header of a stored text: its number of words.
+HEADER = struct.Struct('<I')
+
+
+class Words(object):
+    """
+    The words of a text, the i-th word being text.split()[i], located by their
+    start offsets in the text.
+
+    Only the start offset of one word every Words.STEP words is kept, the
+    others being found by scanning at most STEP words from it, so that
+    slicing a few words out of the text does not depend on its size.
+    """
+    __slots__ = ('text', 'count', '_starts')
+    # Number of words between two kept start offsets.
+    STEP = 8
+
+    def __init__(self, text, count=None, starts=None):
+        """
+        Locate the words of text, unless their count and the array of their
+        kept start offsets are given.
+        """
+        self.text = text
+        if starts is None:
+            starts = [match.start() for match in WORD_PATTERN.finditer(text)]
+            count = len(starts)
+            starts = array('I', starts[::Words.STEP])
+        self.count = count
+        self._starts = starts
+
+    def get_start(self, position):
+        """
+        Return the offset in the text of the word at position, or the length
+        of the text if there is no such word.
+        """
+        if position >= self.count:
+            return len(self.text)
+        start = self._starts[position // Words.STEP]
+        # The first word found is the one of the kept offset.
+        matches = WORD_PATTERN.finditer(self.text, start)
+        for i in xrange(position % Words.STEP + 1):
+            match = next(matches)
+        return match.start()
+
+    def slice(self, lower, upper):
+        """Return the words of position lower to upper included, as text."""
+        return self.text[self.get_start(lower):self.get_start(upper + 1)].rstrip()
+
+    def get_starts(self):
+        """Return the array of the kept start offsets."""
+        return self._starts
+
+
+class DocumentStore(object):
+    """
+    Texts stored zlib compressed, one after the other, in the file 'filename'.
+    Each text is stored with the offsets of its Words, so that the words
+    around a position can be sliced out of the text without splitting all of
+    it, see index.extract_snippet().
+
+    A text is identified by its (offset, size) in the file, returned by add(),
+    which the index keeps instead of the text. The file is only appended to,
+    so a text never moves. It is read with mmap, and only the texts actually
+    read, such as those of the displayed results, are decompressed. The last
+    decompressed texts are kept in an LRU cache.
+
+    The file is read through the descriptor opened with the store, so a
+    reader keeps reading the same file even if it is removed and a new store
+    is written under the same name, as by a new crawling session.
+    Usage:
+    store = DocumentStore('index.json.texts')
+    offset, size = store.add(u'Some text')
+    store.get(offset, size)
+    """
+    # Default number of decompressed texts kept in memory.
+    CACHE_SIZE = 64
+
+    def __init__(self, filename, read_only=False, cache_size=CACHE_SIZE):
+        self._fp = None
+        self._size = 0
+        if os.path.exists(filename):
+            self._size = os.path.getsize(filename)
+        if not read_only:
+            self._fp = open(filename, 'ab')
+        self._read_fp = None
+        if os.path.exists(filename):
+            self._read_fp = open(filename, 'rb')
+        self._map = ''
+        # Serializes the appends of the threads sharing the store.
+        self._lock = threading.Lock()
+        self._cache = LRUCache(cache_size)
+
+    def add(self, text):
+        """Append text and return its (offset, size) in the file."""
+        # A record is the number of words, the kept start offsets of the
+        # words as little endian 32 bits integers and the utf-8 encoded text,
+        # compressed together.
+        words = Words(text)
+        starts = array('I', words.get_starts())
+        if sys.byteorder == 'big':
+            starts.byteswap()
+        data = zlib.compress(HEADER.pack(words.count) + starts.tostring() +
+                            text.encode('utf-8'))
+        with self._lock:
+            offset = self._size
+            self._fp.write(data)
+            self._size += len(data)
+        return offset, len(data)
+
+    def flush(self):
+        """Write the added texts to the file, so that readers can read them."""
+        if self._fp:
+            with self._lock:
+                self._fp.flush()
+
+    def get(self, offset, size):
+        """Return the text stored at offset, of size compressed bytes."""
+        return self.get_words(offset, size).text
+
+    def get_words(self, offset, size):
+        """
+        Return the Words of the text stored at offset, of size compressed
+        bytes.
+        """
+        words = self._cache.get(offset)
+        if words is None:
+            data = self._map
+            if offset + size > len(data):
+                # The text was added since the file was mapped.
+                self.flush()
+                data = self._map = self._open_map()
+            record = zlib.decompress(data[offset:offset + size])
+            count = HEADER.unpack_from(record)[0]
+            text_start = HEADER.size + 4 * ((count + Words.STEP - 1) // Words.STEP)
+            starts = array('I', record[HEADER.size:text_start])
+            if sys.byteorder == 'big':
+                starts.byteswap()
+            words = Words(record[text_start:].decode('utf-8'), count, starts)
+            self._cache.put(offset, words)
+        return words
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+        if self._read_fp:
+            self._read_fp.close()
+            self._read_fp = None
+
+    def _open_map(self):
+        """
+        Map the file opened with the store in memory, read only. An empty or
+        missing file cannot be mapped, an empty string is returned instead.
+        """
+        if not self._read_fp:
+            return ''
+        if os.fstat(self._read_fp.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(self._read_fp.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from htmlutils import HTMLPage
+import httplib
+import logging
+import Queue
+import socket
+import threading
+import urlparse
+
+
+class FetchError(Exception):
+    pass
+
+
+class Fetcher(object):
+    """
+    Fetch web pages concurrently with a pool of threads.
+
+    The urls to fetch are submitted with submit(), and the results are read
+    with get_result(), in the order in which the fetches complete. Each thread
+    keeps its HTTP connections open and reuses them for the next pages of the
+    same host.
+    Usage:
+    fetcher = Fetcher(thread_count=8)
+    fetcher.submit('http://www.python.org')
+    url, page, error = fetcher.get_result()
+    fetcher.close()
+    """
+    USER_AGENT = 'Bananabot'
+    # Maximum number of redirections followed to fetch a page.
+    MAX_REDIRECTIONS = 5
+
+    def __init__(self, thread_count=8, timeout=10, pipeline=None):
+        """
+        Start thread_count fetching threads. timeout is the timeout in seconds
+        of the network operations of each fetch.
+
+        If pipeline, a pipeline.Pipeline, is given, the pages are parsed and
+        tokenized by its processes rather than parsed by the fetching threads,
+        and the results hold pipeline.TokenizedPage objects.
+        """
+        # Get a logger assuming that the logging facility has been set up by the
+        # banana module.
+        self._logger = logging.getLogger(__name__)
+
+        self._timeout = timeout
+        self._pipeline = pipeline
+        self._urls = Queue.Queue()
+        # The results queue is bounded, so that the threads wait for the pages
+        # to be consumed instead of piling them up in memory.
+        self._results = Queue.Queue(thread_count)
+        self._threads = []
+        for i in xrange(thread_count):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, url):
+        """Add url to the urls to fetch."""
+        self._urls.put(url)
+
+    def get_result(self, timeout=None):
+        """
+        Wait for the next fetched url and return a (url, page, error) tuple,
+        page being an htmlutils.HTMLPage object, or a pipeline.TokenizedPage
+        object if the Fetcher has a pipeline, or None if the fetch failed, in
+        which case error is the exception which made it fail.
+        url is the submitted url, while the url of the page is the one it was
+        fetched from, after the redirections.
+        Raise Queue.Empty if no fetch completes within timeout seconds.
+        """
+        return self._results.get(True, timeout)
+
+    def close(self):
+        """
+        Stop the threads once they are done with their current fetch. The
+        urls which were not fetched yet are dropped.
+        """
+        try:
+            while True:
+                self._urls.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in self._threads:
+            self._urls.put(None)
+        # Drain the results so that no thread stays blocked on a full queue.
+        while any(thread.is_alive() for thread in self._threads):
+            try:
+                self._results.get(True, 0.1)
+            except Queue.Empty:
+                pass
+
+    def _run(self):
+        """Main loop of a fetching thread."""
+        # The open connections of this thread, by (scheme, host).
+        connections = {}
+        while True:
+            url = self._urls.get()
+            if url is None:
+                break
+            try:
+                result = (url, self._fetch(url, connections), None)
+            except Exception as e:
+                result = (url, None, e)
+            self._results.put(result)
+        for connection in connections.itervalues():
+            connection.close()
+
+    def _fetch(self, url, connections):
+        """
+        Fetch url using and updating the open connections, and return the page
+        as an htmlutils.HTMLPage object, parsed while its body is received, or
+        as a pipeline.TokenizedPage object if the Fetcher has a pipeline.
+        The page has the url reached after the redirections, against which its
+        relative links are resolved.
+        """
+        for i in xrange(Fetcher.MAX_REDIRECTIONS + 1):
+            response, key = self._request(url, connections)
+            try:
+                if response.status == 200 and self._pipeline:
+                    html = response.read()
+                elif response.status == 200:
+                    page = HTMLPage.from_stream(url, response)
+                else:
+                    # Read the body anyway so that the connection can be
+                    # reused.
+                    response.read()
+            except Exception:
+                # The body may not have been read entirely, so the connection
+                # cannot be reused.
+                self._close_connection(key, connections)
+                raise
+            if response.will_close:
+                self._close_connection(key, connections)
+
+            if response.status == 200 and self._pipeline:
+                return self._pipeline.tokenize(url, html)
+            if response.status == 200:
+                return page
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('location')
+                if not location:
+                    raise FetchError('Redirection without location at url %s' % url)
+                url = urlparse.urljoin(url, location)
+                continue
+            raise FetchError('HTTP error %d at url %s' % (response.status, url))
+        raise FetchError('Too many redirections at url %s' % url)
+
+    def _request(self, url, connections):
+        """
+        Send a GET request for url on the open connection to its host, opening
+        one if necessary, and return the response and the key of the
+        connection in connections. The body of the response must be read
+        before the connection is used again.
+        """
+        parsed_url = urlparse.urlsplit(url)
+        if parsed_url.scheme not in ('http', 'https'):
+            raise FetchError('Unsupported url scheme at url %s' % url)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        key = (parsed_url.scheme, parsed_url.netloc)
+        headers = {'User-Agent': Fetcher.USER_AGENT, 'Connection': 'keep-alive'}
+
+        # A kept alive connection may have been closed by the server in the
+        # meantime, in which case retry once on a new connection.
+        for attempt in (0, 1):
+            connection = connections.get(key)
+            is_new_connection = connection is None
+            if is_new_connection:
+                if parsed_url.scheme == 'https':
+                    connection = httplib.HTTPSConnection(parsed_url.netloc, timeout=self._timeout)
+                else:
+                    connection = httplib.HTTPConnection(parsed_url.netloc, timeout=self._timeout)
+                connections[key] = connection
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self._close_connection(key, connections)
+                if is_new_connection:
+                    raise
+                continue
+            return response, key
+
+    def _close_connection(self, key, connections):
+        """Close the connection of key and remove it from connections."""
+        connections.pop(key).close()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+import heapq
+import itertools
+import time
+import urlparse
+
+
+class Frontier(object):
+    """
+    The urls to crawl, scheduled so that several hosts can be crawled at once
+    without fetching more than one page at a time from any of them.
+
+    Each host has its own queue of urls, a min-heap ordered by priority, which
+    is the depth of the url in the crawl: the number of links followed from
+    the seed url to reach it. Urls of the same depth are crawled in their
+    order of discovery.
+    The hosts with urls to crawl are themselves in a min-heap ordered by the
+    time at which they may be fetched again, which is delay seconds after
+    their previous fetch completed. A host being fetched is out of this heap
+    until done() is called for its url.
+    The Frontier does not check whether an url is already queued: the caller
+    is expected to queue each url once, for instance by recording the urls
+    it discovers in a seenfilter.SeenUrls.
+    Usage:
+    frontier = Frontier()
+    frontier.add('http://www.python.org', 0)
+    url, depth = frontier.pop()
+    # Fetch url...
+    frontier.done(url)
+    """
+    # Default delay in seconds between two fetches from the same host.
+    DELAY = 1.0
+
+    def __init__(self, delay=DELAY):
+        self._delay = delay
+        # The queue of (depth, sequence number, url) of each host.
+        self._host_queues = {}
+        # The (next fetch time, host) of the hosts which have urls to crawl and
+        # are not being fetched.
+        self._ready_hosts = []
+        # The hosts being fetched.
+        self._busy_hosts = set([])
+        # The time after which each host may be fetched again.
+        self._next_fetch_times = {}
+        # The number of queued urls.
+        self._count = 0
+        # Sequence numbers keeping the discovery order in the queues.
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, url, depth=0):
+        """Queue url, found at depth links from the seed url."""
+        self._count += 1
+        host = _get_host(url)
+        queue = self._host_queues.get(host)
+        if queue is None:
+            queue = self._host_queues[host] = []
+            if host not in self._busy_hosts:
+                heapq.heappush(self._ready_hosts,
+                        (self._next_fetch_times.get(host, 0.0), host))
+        heapq.heappush(queue, (depth, next(self._sequence), url))
+
+    def pop(self, now=None):
+        """
+        Return the (url, depth) tuple of the next url to crawl among the
+        hosts which may be fetched at time now, or None if there is none. The
+        host of the url is busy until done() is called for the url.
+        """
+        if now is None:
+            now = time.time()
+        if not self._ready_hosts or self._ready_hosts[0][0] > now:
+            return None
+        host = heapq.heappop(self._ready_hosts)[1]
+        queue = self._host_queues[host]
+        depth, sequence, url = heapq.heappop(queue)
+        if not queue:
+            del self._host_queues[host]
+        self._count -= 1
+        self._busy_hosts.add(host)
+        return url, depth
+
+    def done(self, url, now=None, delay=None):
+        """
+        Notify that the fetch of url, returned by pop(), is complete, so that
+        its host may be fetched again after the delay. delay overrides the
+        delay of the Frontier, for instance with 0 when url was not fetched.
+        """
+        if now is None:
+            now = time.time()
+        if delay is None:
+            delay = self._delay
+        host = _get_host(url)
+        self._busy_hosts.discard(host)
+        next_fetch_time = now + delay
+        if host in self._host_queues:
+            heapq.heappush(self._ready_hosts, (next_fetch_time, host))
+        else:
+            self._next_fetch_times[host] = next_fetch_time
+        # Forget the hosts which may already be fetched again.
+        if len(self._next_fetch_times) > 2 * len(self._host_queues) + 1000:
+            self._next_fetch_times = dict((host, fetch_time)
+                    for host, fetch_time in self._next_fetch_times.iteritems()
+                    if fetch_time > now)
+
+    def get_wait_time(self, now=None):
+        """
+        Return the number of seconds until a host may be fetched, 0 if one
+        may be fetched right now, or None if no host has urls to crawl or all
+        of them are being fetched.
+        """
+        if not self._ready_hosts:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0.0, self._ready_hosts[0][0] - now)
+
+    def to_json(self):
+        """Return the list of the [url, depth] of the queued urls."""
+        return [[url, depth] for queue in self._host_queues.itervalues()
+                for depth, sequence, url in sorted(queue)]
+
+    def load_json(self, json):
+        """
+        Queue the urls of json, as returned by to_json(). A plain list of
+        urls is also accepted, for the crawler.json files dumped before the
+        depths were introduced.
+        """
+        for item in json:
+            if isinstance(item, basestring):
+                self.add(item)
+            else:
+                self.add(item[0], item[1])
+
+
+def _get_host(url):
+    """Return the host part of url."""
+    return urlparse.urlsplit(url).netloc.lower()
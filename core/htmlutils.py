@@ -15,7 +15,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with banana.  If not, see <http://www.gnu.org/licenses/>.
+import codecs
 from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 import logging
 import urllib2
 import urlparse
@@ -28,14 +30,19 @@ class HTMLPage(object):
     The text is provided as is, this means that you might need to remove spaces
     and line breaks.
     """
-    def __init__(self, url, html):
+    # Size in bytes of the chunks read by from_stream().
+    CHUNK_SIZE = 16384
+
+    def __init__(self, url, html=None, parser=None):
         """
         Build an html page representation from its url and its html code
-        converted to unicode.
+        converted to unicode, or from a BananaHTMLParser which already parsed
+        the page.
         """
-        # Run the parser on the page and get the relevant info.
-        parser = BananaHTMLParser()
-        parser.parse(html)
+        if parser is None:
+            # Run the parser on the page and get the relevant info.
+            parser = BananaHTMLParser()
+            parser.parse(html)
 
         # Fill the members with the retrieved data.
         # The url of the page.
@@ -59,6 +66,23 @@ class HTMLPage(object):
         # The full text of the page.
         self.text = parser.text
 
+    @staticmethod
+    def from_stream(url, stream, chunk_size=CHUNK_SIZE):
+        """
+        Build the html page representation of url from the file like object
+        stream, for instance an HTTP response, whose content is utf-8 encoded
+        html. The page is parsed chunk by chunk while it is read, so it is
+        never held in memory as a whole.
+        """
+        parser = BananaHTMLParser()
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed_bytes(chunk)
+        parser.close()
+        return HTMLPage(url, parser=parser)
+
 
 class MalformedHTMLException(Exception):
     pass
@@ -72,6 +96,12 @@ class BananaHTMLParser(HTMLParser):
     The stored in formation contains the raw links as they are found in the html
     (so you might need to build their full url by prepending the domain name to
     them), the title of the page and the full text of the page.
+
+    The document may also be fed in several chunks of utf-8 encoded bytes with
+    feed_bytes(), for instance as they are received from the network, and
+    then close() must be called. The consecutive pieces of data, entity and
+    character references between two tags are buffered and handled at once,
+    so a text split across chunks is handled as if it was read in one piece.
     Usage:
     parser = BananaHTMLParser()
     parser.parse(myHTMLString)
@@ -83,25 +113,39 @@ class BananaHTMLParser(HTMLParser):
     TEXT_TAGS = set(['p', 'h1', 'h2', 'h3', 'h4', 'h5'])
 
     def __init__(self):
-        HTMLParser.__init__(self)
-
         # Get a logger assuming that the logging facility has been set up by the
         # banana module.
         self._logger = logging.getLogger(__name__)
 
+        # HTMLParser.__init__() calls reset(), which sets up the other members.
+        HTMLParser.__init__(self)
+
+    def reset(self):
+        """Re-initialize the parser and the page information."""
+        HTMLParser.reset(self)
         self._tags_stack = []
         self._current_tag = None
+        # The number of TEXT_TAGS in the tags stack.
+        self._text_tag_count = 0
         # Flag use to detect titles that contain only a link, like the following
         # pattern: <h1><a href='/about'>about</a></h1>
         # So _is_first_chunk_of_text_data is set to False by the first handled data
         # of the current tag.
         self._is_first_chunk_of_text_data = True
+        # The pieces of data read since the last tag.
+        self._pending_data = []
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._text_chunks = []
 
         # Public page information.
         # TODO set this as properties to avoid external modifications.
         self.links = []
         self.title = ''
-        self.text = ''
+
+    @property
+    def text(self):
+        """The full text of the page."""
+        return u''.join(self._text_chunks)
 
     def parse(self, html):
         """
@@ -110,17 +154,23 @@ class BananaHTMLParser(HTMLParser):
         available through the public members.
         """
         # First re-initialize the object data.
-        self.links = []
-        self.title = ''
-        self.text = ''
-
-        # Tricky undocumented method of HTMLParser to keep the html entities
-        # characters.
-        html =  self.unescape(html)
+        self.reset()
         # Parse the html code.
         self.feed(html)
+        self.close()
+
+    def feed_bytes(self, data):
+        """Feed the next chunk of the utf-8 encoded html code to parse."""
+        self.feed(self._decoder.decode(data))
+
+    def close(self):
+        """Parse the html code remaining after the last fed chunk."""
+        self.feed(self._decoder.decode('', True))
+        HTMLParser.close(self)
+        self._flush_data()
 
     def handle_starttag(self, tag, attrs):
+        self._flush_data()
         self._current_tag = tag
         self._tags_stack.append(tag)
         # Handle the links.
@@ -134,9 +184,11 @@ class BananaHTMLParser(HTMLParser):
         # If the opened flag is a text flag, update the first text data flag
         # accordingly.
         if tag in BananaHTMLParser.TEXT_TAGS:
+            self._text_tag_count += 1
             self._is_first_chunk_of_text_data = True
 
     def handle_endtag(self, tag):
+        self._flush_data()
         # Check the the end tag matches the current tag. If not, the html is
         # malformed. In this case, try to close the open tag corresponding to
         # the end tag that is the nearest in the tags stack. If it is not
@@ -144,27 +196,27 @@ class BananaHTMLParser(HTMLParser):
         if tag != self._current_tag:
             self._logger.debug('The end tag %s does not match the current tag %s. '
                 'Try to find a corresponding open tag.' % (tag, self._current_tag))
-            self._logger.debug('Current html context:\n' + str(self._tags_stack))
-            # Iterate on the tags stack in reverse order. Use an enumerate()
-            # trick to also know the current index in the original list. Then if
-            # found, save the index at which the first open tag matching the
-            # closing tag is found.
+            # Search the tags stack from its top, and if found, close the
+            # first open tag matching the closing tag and the tags above it.
             matching_index = None
-            for index, open_tag in reversed(list(enumerate(self._tags_stack))):
-                if open_tag == tag:
-                    self._logger.debug('Found a matching open tag at index %d' % index)
+            for index in xrange(len(self._tags_stack) - 1, -1, -1):
+                if self._tags_stack[index] == tag:
                     matching_index = index
                     break
             if matching_index is not None:
                 # A matching open tag was found, update the tag stack.
-                self._tags_stack = self._tags_stack[:matching_index]
-                self._logger.debug('Updated html context:\n' + str(self._tags_stack))
+                self._logger.debug('Found a matching open tag at index %d' % matching_index)
+                for open_tag in self._tags_stack[matching_index:]:
+                    if open_tag in BananaHTMLParser.TEXT_TAGS:
+                        self._text_tag_count -= 1
+                del self._tags_stack[matching_index:]
             else:
                 self._logger.debug('No matching open tag was found. Try to continue.')
                 # raise MalformedHTMLException('The end tag %s does not match '
                                 # 'the current tag %s' % (tag, self._current_tag))
         else:
-            self._tags_stack.pop()
+            if self._tags_stack.pop() in BananaHTMLParser.TEXT_TAGS:
+                self._text_tag_count -= 1
         # Update the current tag.
         if self._tags_stack:
             self._current_tag = self._tags_stack[-1]
@@ -172,6 +224,46 @@ class BananaHTMLParser(HTMLParser):
             self._current_tag = None
 
     def handle_data(self, data):
+        self._pending_data.append(data)
+
+    def handle_entityref(self, name):
+        # Keep the html entities characters, and the unknown entities as is.
+        codepoint = name2codepoint.get(name)
+        if name == 'apos':
+            codepoint = ord("'")
+        if codepoint is None:
+            self._pending_data.append(u'&%s;' % name)
+        else:
+            self._pending_data.append(unichr(codepoint))
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ('x', 'X'):
+                self._pending_data.append(unichr(int(name[1:], 16)))
+            else:
+                self._pending_data.append(unichr(int(name)))
+        except (ValueError, OverflowError):
+            self._pending_data.append(u'&#' + name + u';')
+
+    def handle_comment(self, data):
+        self._flush_data()
+
+    def handle_decl(self, decl):
+        self._flush_data()
+
+    def handle_pi(self, data):
+        self._flush_data()
+
+    def unknown_decl(self, data):
+        self._flush_data()
+
+    def _flush_data(self):
+        """Handle the data read since the last tag."""
+        if not self._pending_data:
+            return
+        data = u''.join(self._pending_data)
+        self._pending_data = []
+
         # Handle the title.
         if self._current_tag == BananaHTMLParser.TITLE_TAG:
             # There must be only one title in the page, so make sure this is the
@@ -186,21 +278,16 @@ class BananaHTMLParser(HTMLParser):
 
         # Handle the text. If the current context is a text context, the current
         # data is some text, so store it.
-        elif self._is_text_context():
+        elif self._text_tag_count:
             # Also verify that this is not a single link in a title pattern with
             # _is_first_chunk_of_text_data.
            if not (self._current_tag == BananaHTMLParser.LINK_TAG and self._is_first_chunk_of_text_data):
                 # Add a space separator at the end of data.
-                self.text += data + u' '
+                self._text_chunks.append(data)
+                self._text_chunks.append(u' ')
                 # We handled some text data, so update the flag accordingly.
                 self._is_first_chunk_of_text_data = False
 
-    def _is_text_context(self):
-        """
-        A text context means that a TEXT_TAGS can be found in the curent tags stack.
-        """
-        return bool(set(self._tags_stack) & BananaHTMLParser.TEXT_TAGS)
-
 
 def main():
     """Method used for testing."""
@@ -16,131 +16,340 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with banana.  If not, see <http://www.gnu.org/licenses/>.
 #-*- coding: utf-8 -*-
-import blobprocessor
+from analysis import Analyzer, SIMPLE_SETTINGS
+from array import array
+from bisect import bisect_left
+from docstore import DocumentStore, Words
 import json
 import logging
+import os
+from pipeline import TokenizedPage
 import re
+from scoring import compute_norms
+import threading
 import time
 import unicodedata
 import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Index(object):
     """
     Represents an inverted index which can be searched, modified, saved and read
     back.
+
+    On the disk, an index is made of a json snapshot, 'filename', and of a log
+    to which each added page is appended, 'filename'.log. So persisting a page
+    only costs the size of the page. From time to time, the log is compacted
+    in the background: it is renamed to 'filename'.log.compacting and replayed
+    on top of the previous snapshot to write a new snapshot, while the pages
+    added in the meantime go to a new log.
+
+    Searchers only read the snapshot, which is always complete since it is
+    renamed in place once written.
+
+    The full texts of the pages are kept out of the snapshot and of the log,
+    compressed in a docstore.DocumentStore, 'filename'.texts, and are only
+    read back to make the snippets of the displayed results.
     """
     # Filename of the file to which the index will be dumped.
     FILENAME = 'index.json'
+    # Version of the json format written by dump(). Indexes dumped before the
+    # format was versioned are keyed by urls instead of doc ids, and those of
+    # version 2 hold the full texts of the pages.
+    FORMAT_VERSION = 3
 
-    def __init__(self, restart):
+    def __init__(self, restart, filename=None, read_only=False, analyzer=None,
+                store=None):
         """
         Make an empty index unless 'restart' is True, in that case load a
-        previously dumped index from Index.FILENAME.
+        previously dumped index from 'filename', which defaults to
+        Index.FILENAME.
+
+        The pages of an empty index are analyzed with analyzer, an
+        analysis.Analyzer, or with a default Analyzer if it is None. A loaded
+        index keeps analyzing its pages as it did when it was built.
+
+        A read_only index is never dumped back to the disk, this is what the
+        searchers use so that they can share an index file with a crawling
+        session without rewriting it.
+
+        store is the docstore.DocumentStore of the full texts, by default the
+        one of 'filename'. It is given to share the store of a writing index.
         """
         # Get a logger assuming that the logging facility has been set up by the
         # banana module.
         self._logger = logging.getLogger(__name__)
 
+        self._filename = filename or Index.FILENAME
+        self._read_only = read_only
+        self._analyzer = analyzer or Analyzer()
+
         # Indexed urls and their associated information such as id, length of
-        # title and full text and the full text of the page itself.
+        # title and full text and the location of the full text in the store.
         self._urls = {}
+        # The urls by doc id, the doc id of an url being its index in the list.
+        # The InvertedIndex objects only deal with doc ids.
+        self._doc_urls = []
 
+        # The inverted indexes also hold the length statistics of their field.
         self._title_index = InvertedIndex()
         self._full_text_index = InvertedIndex()
 
-        # Index statistics.
-        self._average_title_length = 0
-        self._average_full_text_length = 0
-
-        # Counter to periodically dump the index when entries are added. The
-        # _dump_interval_counter is incremented at each time that an entry is added.
-        self._dump_interval = 20
-        self._dump_interval_counter = 0
+        # Log of the pages added since the last compaction. The log is
+        # compacted in a new snapshot when it holds at least
+        # _compaction_min_count pages and _compaction_ratio times as many pages
+        # as the snapshot, so that the total size of the compactions stays
+        # proportional to the size of the index.
+        self._log_filename = self._filename + '.log'
+        self._compacting_log_filename = self._log_filename + '.compacting'
+        self._log_fp = None
+        self._log_count = 0
+        self._snapshot_count = 0
+        self._compaction_min_count = 100
+        self._compaction_ratio = 0.5
+        self._compaction_thread = None
+
+        # The texts of a new session are written to a new store. A searcher
+        # which opened the previous one keeps reading it until it reloads.
+        self._store = store
+        if store is None:
+            store_filename = self._filename + '.texts'
+            if not restart and not read_only and os.path.exists(store_filename):
+                os.remove(store_filename)
+            self._store = DocumentStore(store_filename, read_only)
+        self._loaded_format_version = Index.FORMAT_VERSION
 
         # Load the previously saved index if necessary.
         if restart:
-            self.load(Index.FILENAME)
+            if os.path.exists(self._filename):
+                self.load(self._filename)
+            elif read_only:
+                raise Exception('No index file %s to load.' % self._filename)
+
+        if not read_only:
+            self._snapshot_count = self.get_indexed_url_count()
+            if restart:
+                # Replay the pages of the previous session which were not
+                # compacted yet.
+                for log_filename in (self._compacting_log_filename, self._log_filename):
+                    if os.path.exists(log_filename):
+                        self._replay_log(log_filename)
+            if (self._log_count or not restart or
+                    self._loaded_format_version != Index.FORMAT_VERSION):
+                # Start from a clean snapshot: the previous session's logs or
+                # the previous index of a new session are obsolete, and an
+                # index of a former format is converted.
+                self._compact_now()
+            self._log_fp = open(self._log_filename, 'a')
 
     def __del__(self):
-        self._logger.debug('Deleting Index, dumping the index content.')
-        self.dump(Index.FILENAME)
+        if not self._read_only:
+            self._logger.debug('Deleting Index, compacting the index log.')
+            self.close()
+
+    def close(self):
+        """
+        Wait for a running compaction, then compact the log in a new snapshot.
+        A closed index cannot be modified anymore.
+        """
+        if self._log_fp is None:
+            return
+        if self._compaction_thread:
+            self._compaction_thread.join()
+        self._log_fp.close()
+        self._log_fp = None
+        if self._log_count:
+            self._compact_now()
+        self._store.close()
+
+    def _compact_now(self):
+        """Write a new snapshot of the whole index and remove the logs."""
+        self.dump(self._filename)
+        for log_filename in (self._compacting_log_filename, self._log_filename):
+            if os.path.exists(log_filename):
+                os.remove(log_filename)
+        self._snapshot_count = self.get_indexed_url_count()
+        self._log_count = 0
+
+    def _start_compaction(self):
+        """
+        Freeze the log and start a thread compacting it with the current
+        snapshot in a new snapshot, unless a compaction is already running.
+        """
+        if self._compaction_thread and self._compaction_thread.is_alive():
+            return
+        self._log_fp.close()
+        if os.path.exists(self._compacting_log_filename):
+            # A previous compaction failed, keep its log and append ours.
+            with open(self._compacting_log_filename, 'a') as compacting_fp:
+                with open(self._log_filename) as fp:
+                    compacting_fp.write(fp.read())
+            os.remove(self._log_filename)
+        else:
+            os.rename(self._log_filename, self._compacting_log_filename)
+        self._log_fp = open(self._log_filename, 'a')
+        self._snapshot_count = self.get_indexed_url_count()
+        self._log_count = 0
+
+        self._logger.info('Compacting the index log in the background.')
+        self._compaction_thread = threading.Thread(target=_compact,
+                args=(self._filename, self._compacting_log_filename,
+                    self._analyzer, self._store))
+        self._compaction_thread.daemon = True
+        self._compaction_thread.start()
+
+    def _replay_log(self, log_filename):
+        """Add the pages of the log 'log_filename' to the index."""
+        self._logger.info('Replaying the index log \'%s\'.' % log_filename)
+        with open(log_filename) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may have been partially written if the
+                    # previous session crashed.
+                    self._logger.warning('Skipping a truncated record in the '
+                            'index log \'%s\'.' % log_filename)
+                    continue
+                if 'text' in record:
+                    # Logged before the texts were stored apart.
+                    text = record['text']
+                    text_location = None
+                else:
+                    text_location = (record['text_offset'], record['text_size'])
+                    text = self._store.get(*text_location)
+                page = TokenizedPage(record['url'], record['title'], text,
+                                    self._analyzer)
+                self._add_document(page, record['date'], text_location)
+                self._log_count += 1
+
+    def get_analyzer(self):
+        """Return the analysis.Analyzer of the pages and of the queries."""
+        return self._analyzer
 
     def get_title_index(self):
         return self._title_index
 
+    def get_cache_stats(self):
+        """
+        Return None, all the posting lists of an Index being in memory
+        without cache.
+        """
+        return None
+
     def get_full_text_index(self):
         return self._full_text_index
 
     def get_indexed_url_count(self):
         return len(self._urls)
 
-    def get_title(self, url):
-        """Get the title of the page associated with url."""
-        return self._urls[url]['title']
+    def get_doc_id(self, url):
+        """Return the doc id of url or None if url is not indexed."""
+        url_info = self._urls.get(url)
+        if url_info:
+            return url_info['id']
+        return None
+
+    def get_url(self, doc_id):
+        return self._doc_urls[doc_id]
+
+    def get_title(self, doc_id):
+        """Get the title of the page associated with doc_id."""
+        return self._urls[self._doc_urls[doc_id]]['title']
+
+    def get_full_text(self, doc_id):
+        """Get the full text of the page associated with doc_id."""
+        url_info = self._urls[self._doc_urls[doc_id]]
+        if 'full_text' in url_info:
+            # A read only index of the former format holds its texts.
+            return url_info['full_text']
+        return self._store.get(url_info['text_offset'], url_info['text_size'])
+
+    def _get_words(self, doc_id):
+        """Get the docstore.Words of the full text associated with doc_id."""
+        url_info = self._urls[self._doc_urls[doc_id]]
+        if 'full_text' in url_info:
+            return Words(url_info['full_text'])
+        return self._store.get_words(url_info['text_offset'],
+                                    url_info['text_size'])
+
+    def get_average_title_length(self):
+        return self._title_index.get_average_length()
+
+    def get_average_full_text_length(self):
+        return self._full_text_index.get_average_length()
+
+    def iter_documents(self):
+        """
+        Iterate on the (doc_id, url, url_info) tuples of the indexed urls, in
+        the order of their doc ids.
+        """
+        for doc_id, url in enumerate(self._doc_urls):
+            yield doc_id, url, self._urls[url]
 
-    def make_snippet(self, url, tokens, context_before, context_after,
+    def make_snippet(self, doc_id, tokens, context_before, context_after,
                     max_match_count):
         """
-        Return a snippet of the full text of the url relevant with respect to
-        the tokens.
+        Return a snippet of the full text of the document doc_id relevant with
+        respect to the tokens, and the positions of the matching words in the
+        snippet.
 
-        context_before and context_after are the number of tokens before and
-        after the matching token that will be included in the snippet.
+        context_before and context_after are the number of words before and
+        after the matching words that will be included in the snippet.
         max_match_count is the chosen maximum of matches that will be used to
         make the snippet. This is useful to avoid huge snippets when a token is
         matched several times in the full_text.
-        The returned value is the snippet as a single string.
+        The returned value is a (snippet, highlights) tuple, the snippet being
+        a single string and highlights the sorted list of the indexes of the
+        matching words in snippet.split().
         """
         # Get the matching positions in the url full text.
         positions = []
-        for token in tokens:
-            positions += self._full_text_index.get_match_positions_in_url(url, token)
-
-        # Extract snippets of the full text around the matching positions.
-        snippet = []
-        url_info = self._urls[url]
-        for position in positions[0:max_match_count - 1]:
-            # Compute the lower and upper bound of the snippet to extract from
-            # the full_text. Pay attention to limit cases when position is close
-            # to the start or end of the full_text.
-            lower_bound = position - context_before
-            if lower_bound < 0:
-                lower_bound = 0
-            upper_bound = position + context_after
-            if upper_bound >= len(url_info['full_text']):
-                upper_bound = len(url_info['full_text']) - 1
-            # Append a slice of the full_text followed by an ellipsis to the snippet.
-            # u'\u2026' is the unicode value of an ellipsis.
-            snippet += url_info['full_text'].split()[lower_bound:upper_bound]
-            snippet += u'\u2026'
-
-        # Finally return the composed snippet as a single string.
-        return ' '.join(snippet)
+        for token in set(tokens):
+            positions += self._full_text_index.get_match_positions_in_doc(doc_id, token)
+
+        return extract_snippet(self._get_words(doc_id), positions,
+                            context_before, context_after, max_match_count)
 
     def dump(self, filename, prettify=False):
         """
         Dumps the inverted index in a json format to 'filename'. The usual
         filename used is 'index.json'. If 'prettify' is True, the json is dumped
         in a more human readable format.
+
+        The index is first written to a temporary file which is then renamed to
+        'filename', so that a searcher watching 'filename' never reads a
+        partially written index. The texts added to the store are written
+        before, so that the snapshot only refers to texts already on the disk.
         """
+        self._store.flush()
         self._logger.info('Dumping the inverted index to \'%s\'.' % filename)
         self._logger.info('The index to dump contains %d entries.' % self._full_text_index.get_entry_count())
         self._logger.info('A total of %d urls are indexed.' % self.get_indexed_url_count())
         # Dump the attributes of the class in json. In the future, pickle or
         # shelve will be used, but for now json provides human readable data
         # nice for debugging.
-        with open(filename, 'w') as fp:
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'w') as fp:
             # Make a json serializable object representing the Index.
-            json_to_dump = {'_urls': self._urls,
+            json_to_dump = {'_format_version': Index.FORMAT_VERSION,
+                    '_analyzer': self._analyzer.to_json(),
+                    '_urls': self._urls,
                     '_title_index': self._title_index.to_json(),
-                    '_full_text_index': self._full_text_index.to_json(),
-                    '_average_title_length': self._average_title_length,
-                    '_average_full_text_length': self._average_full_text_length}
+                    '_full_text_index': self._full_text_index.to_json()}
             if prettify:
                 json.dump(json_to_dump, fp, sort_keys=True, indent=4)
             else:
                 json.dump(json_to_dump, fp)
+        # os.rename() is atomic on posix but does not overwrite an existing file
+        # on windows.
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temporary_filename, filename)
 
     def load(self, filename):
         """
@@ -151,99 +360,346 @@ class Index(object):
         with open(filename) as fp:
             loaded_json = json.load(fp)
             self._urls = loaded_json['_urls']
-            self._title_index = InvertedIndex(loaded_json['_title_index'])
-            self._full_text_index = InvertedIndex(loaded_json['_full_text_index'])
-            self._average_title_length = loaded_json['_average_title_length']
-            self._average_full_text_length = loaded_json['_average_full_text_length']
+            # The indexes dumped before the analyzers were introduced were
+            # analyzed like with the simple settings.
+            self._analyzer = Analyzer.from_json(loaded_json.get('_analyzer',
+                                                            SIMPLE_SETTINGS))
+            self._loaded_format_version = loaded_json.get('_format_version')
+            if self._loaded_format_version in (2, Index.FORMAT_VERSION):
+                self._doc_urls = [None] * len(self._urls)
+                for url, url_info in self._urls.iteritems():
+                    self._doc_urls[url_info['id']] = url
+                self._title_index = InvertedIndex(loaded_json['_title_index'])
+                self._full_text_index = InvertedIndex(loaded_json['_full_text_index'])
+            else:
+                self._load_url_keyed_indexes(loaded_json)
+        # The lengths of the fields are not dumped with the inverted indexes
+        # since they are already in the url information.
+        for doc_id, url in enumerate(self._doc_urls):
+            url_info = self._urls[url]
+            self._title_index.set_length(doc_id, url_info['title_length'])
+            self._full_text_index.set_length(doc_id, url_info['full_text_length'])
+            # Move the texts of an index of the former format to the store,
+            # unless the index cannot be written.
+            if 'full_text' in url_info and not self._read_only:
+                url_info['text_offset'], url_info['text_size'] = \
+                        self._store.add(url_info.pop('full_text'))
         self._logger.info('The loaded index contains %d entries.' % self._full_text_index.get_entry_count())
         self._logger.info('A total of %d urls are indexed.' % self.get_indexed_url_count())
 
+    def _load_url_keyed_indexes(self, loaded_json):
+        """
+        Load the inverted indexes of an index dumped before the doc ids were
+        introduced, in which the postings are keyed by urls. The urls are given
+        new contiguous doc ids in the order of their former ids.
+        """
+        self._logger.info('Converting the url keyed index to doc ids.')
+        self._doc_urls = sorted(self._urls, key=lambda url: self._urls[url]['id'])
+        for doc_id, url in enumerate(self._doc_urls):
+            self._urls[url]['id'] = doc_id
+        self._title_index = InvertedIndex()
+        self._full_text_index = InvertedIndex()
+        for inverted_index, key in ((self._title_index, '_title_index'),
+                                    (self._full_text_index, '_full_text_index')):
+            for token, urls in loaded_json[key].iteritems():
+                for url, positions in urls.iteritems():
+                    inverted_index.add_entries(self._urls[url]['id'],
+                            ((token, position) for position in positions))
+
     def add_entry(self, page):
         """
         Index a page represented by an htmlutils.HTMLPage object.
         """
+        self.add_tokenized_page(TokenizedPage(page.url, page.title, page.text,
+                                            self._analyzer))
+
+    def add_tokenized_page(self, page):
+        """
+        Index a page represented by a pipeline.TokenizedPage object, for
+        instance tokenized by a pipeline.Pipeline. It must have been
+        tokenized with the settings of the analyzer of the index.
+        """
+        if self._read_only:
+            raise Exception('Unable to add an entry to a read only Index.')
+        # Log the page before indexing it, a log record only holds what is
+        # needed to index the page again. Its text is stored first, so that
+        # the log never refers to a text which is not on the disk.
+        date = time.time()
+        text_offset, text_size = self._store.add(page.text)
+        self._store.flush()
+        json.dump({'url': page.url, 'title': page.title,
+                'text_offset': text_offset, 'text_size': text_size,
+                'date': date}, self._log_fp)
+        self._log_fp.write('\n')
+        self._log_fp.flush()
+        self._log_count += 1
+
+        self._add_document(page, date, (text_offset, text_size))
+
+        # Now that the entry is added, compact the log if necessary.
+        if (self._log_count >= self._compaction_min_count and
+                self._log_count >= self._compaction_ratio * self._snapshot_count):
+            self._start_compaction()
+
+    def _add_document(self, page, date, text_location=None):
+        """
+        Index the pipeline.TokenizedPage page, indexed at date in seconds since
+        epoch. text_location is the (offset, size) of the text of the page in
+        the store, where it is added if it is None.
+        """
+        url = page.url
         # self._logger.debug('Adding entry in index for url %s' % url)
         # If the url is already indexed, print when it was done and remove its
-        # data from the indexes.
-        if page.url in self._urls:
-            delta_days = (time.time() - self._urls[page.url]['date']) / 86400
-            self._logger.info('The url %s was already indexed %d days ago.' % (page.url, delta_days))
-            self._title_index.remove_entry(page.url)
-            self._full_text_index.remove_entry(page.url)
+        # data from the indexes. It keeps its doc id.
+        url_info = self._urls.get(url)
+        if url_info:
+            doc_id = url_info['id']
+            delta_days = (date - url_info['date']) / 86400
+            self._logger.info('The url %s was already indexed %d days ago.' % (url, delta_days))
+            # The entries of the previous version of the page are found by
+            # tokenizing its stored title and text again, with the same
+            # analyzer, so that only the posting lists of its own tokens are
+            # visited.
+            previous_page = TokenizedPage(url, url_info['title'],
+                                        self.get_full_text(doc_id),
+                                        self._analyzer)
+            self._title_index.remove_entry(doc_id, previous_page.title_tokens)
+            self._full_text_index.remove_entry(doc_id, previous_page.text_tokens)
+        else:
+            doc_id = len(self._doc_urls)
+            self._doc_urls.append(url)
 
         # Index the title of the page in the _title_index.
-        title_length = 0
-        tokenized_title = []
         if page.title:
-            title_length = len(page.title.split())
-            tokenized_title = blobprocessor.make_tokens_and_position(page.title)
-            for token_and_position in tokenized_title:
-                self._title_index.add_entry(page.url, token_and_position[0],
-                        token_and_position[1])
+            self._title_index.add_entries(doc_id, page.title_tokens)
         else:
-            self._logger.warning('Unable to get title from url \'%s\'' % page.url)
-
-        # Index the full text of the page in the _full_text_index.
-        # Try to get the text of the page, prepare it removing as much markup as
-        # possible and tokenize it.
-        blob = blobprocessor.remove_meaningless_chars(page.text)
-
-        blob_length = 0
-        tokens = []
-        if blob:
-            blob_length = len(blob.split())
-            tokenized_blob = blobprocessor.make_tokens_and_position(blob)
-            for token_and_position in tokenized_blob:
-                self._full_text_index.add_entry(page.url, token_and_position[0],
-                        token_and_position[1])
+            self._logger.warning('Unable to get title from url \'%s\'' % url)
+
+        # Index the full text of the page in the _full_text_index, the text
+        # having been stripped of its meaningless characters and tokenized.
+        if page.text:
+            self._full_text_index.add_entries(doc_id, page.text_tokens)
         else:
-            self._logger.warning('Unable to get text from url \'%s\'' % page.url)
+            self._logger.warning('Unable to get text from url \'%s\'' % url)
 
         # Save page info.
-        url_info = self._urls.setdefault(page.url, {})
-        # Url id. Notice that we've just inserted the entry corresponding to url
-        # in _urls so its length has just been incremented.
-        url_info['id'] = len(self._urls)
+        url_info = self._urls.setdefault(url, {})
+        # Url id, its index in _doc_urls.
+        url_info['id'] = doc_id
         # Indexing date in second since epoch.
-        url_info['date'] = time.time()
+        url_info['date'] = date
         # Main title of the page.
         url_info['title'] = page.title
         # Number of tokens in the title of the page.
-        url_info['title_length'] = title_length
-        # Full text of the page in a string.
-        # url_info['full_text'] = ' '.join((token for token in tokens))
-        url_info['full_text'] = blob
+        url_info['title_length'] = page.title_length
+        # Location of the full text of the page in the store.
+        if text_location is None:
+            text_location = self._store.add(page.text)
+        url_info['text_offset'], url_info['text_size'] = text_location
+        url_info.pop('full_text', None)
         # Number of tokens in the whole page.
-        url_info['full_text_length'] = blob_length
+        url_info['full_text_length'] = page.text_length
 
         # Update index statistics.
-        self._average_title_length = (self._average_title_length +
-                url_info['title_length'] / url_info['id'])
-        self._average_full_text_length = (self._average_full_text_length +
-                url_info['full_text_length'] / url_info['id'])
+        self._title_index.set_length(doc_id, page.title_length)
+        self._full_text_index.set_length(doc_id, page.text_length)
+
+
+def _compact(filename, log_filename, analyzer, store):
+    """
+    Replay the log 'log_filename' on top of the snapshot 'filename' and write
+    the result as the new snapshot. This runs in the compaction thread of an
+    Index, on an Index of its own, analyzing the pages with analyzer and
+    sharing the store of the full texts.
+    """
+    index = Index(os.path.exists(filename), filename, read_only=True,
+                analyzer=analyzer, store=store)
+    index._replay_log(log_filename)
+    index.dump(filename)
+    os.remove(log_filename)
 
-        # Now that the entry is added, increment the added entry count and dump
-        # the index if necessary.
-        self._dump_interval_counter += 1
-        if self._dump_interval_counter >= self._dump_interval:
-            self._dump_interval_counter = 0
-            self.dump(Index.FILENAME)
+
+def extract_snippet(words, positions, context_before, context_after,
+                    max_match_count):
+    """
+    Extract a snippet from a full text around the given word positions and
+    return it with the positions of the matching words in the snippet, see
+    Index.make_snippet(). words are the docstore.Words of the full text.
+
+    The windows of words around the matches are sliced out of the full text
+    with the word offsets, overlapping or adjacent windows being merged, so
+    the cost only depends on the size of the snippet.
+    """
+    word_count = words.count
+    # The [lower, upper, positions] windows of words to extract, upper being
+    # included.
+    windows = []
+    for position in sorted(set(positions))[:max_match_count]:
+        if position >= word_count:
+            continue
+        lower = max(0, position - context_before)
+        upper = min(word_count - 1, position + context_after)
+        if windows and lower <= windows[-1][1] + 1:
+            windows[-1][1] = max(windows[-1][1], upper)
+            windows[-1][2].append(position)
+        else:
+            windows.append([lower, upper, [position]])
+
+    # Join the windows with ellipses, u'\u2026' being the unicode value of an
+    # ellipsis, which count as words of the snippet.
+    snippet = []
+    highlights = []
+    word_index = 0
+    for lower, upper, window_positions in windows:
+        if lower > 0:
+            snippet.append(u'\u2026')
+            word_index += 1
+        highlights.extend(word_index + position - lower
+                        for position in window_positions)
+        snippet.append(words.slice(lower, upper))
+        word_index += upper + 1 - lower
+    if windows and windows[-1][1] < word_count - 1:
+        snippet.append(u'\u2026')
+
+    # Finally return the composed snippet as a single string.
+    return u' '.join(snippet), highlights
+
+
+class PostingList(object):
+    """
+    The postings of a token: the sorted ids of the documents containing the
+    token and the positions of the token in each of these documents.
+
+    The postings are packed in arrays of unsigned integers rather than in
+    Python lists and dicts, the positions of the token in the document
+    doc_ids[i] being positions[offsets[i]:offsets[i + 1]].
+    """
+    __slots__ = ('doc_ids', 'offsets', 'positions')
+
+    def __init__(self, json=None):
+        """
+        Build an empty PostingList or initialize it from the optional json
+        argument, as returned by to_json().
+        """
+        if json:
+            self.doc_ids = array('I', json[0])
+            self.offsets = array('I', json[1])
+            self.positions = array('I', json[2])
+        else:
+            self.doc_ids = array('I')
+            self.offsets = array('I', [0])
+            self.positions = array('I')
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def _find(self, doc_id):
+        """Return the index of doc_id in doc_ids or None if it is not there."""
+        i = bisect_left(self.doc_ids, doc_id)
+        if i < len(self.doc_ids) and self.doc_ids[i] == doc_id:
+            return i
+        return None
+
+    def add(self, doc_id, positions):
+        """
+        Add the sorted positions of the token in the document doc_id, which
+        must not already be in the PostingList.
+
+        Documents are usually added in the increasing order of their ids, in
+        which case this is a mere append.
+        """
+        if not self.doc_ids or self.doc_ids[-1] < doc_id:
+            self.doc_ids.append(doc_id)
+            self.positions.extend(positions)
+            self.offsets.append(len(self.positions))
+            return
+
+        # The document is inserted in the middle of the list, shift the
+        # offsets of the following documents.
+        i = bisect_left(self.doc_ids, doc_id)
+        start = self.offsets[i]
+        count = len(positions)
+        self.doc_ids.insert(i, doc_id)
+        self.positions[start:start] = array('I', positions)
+        self.offsets.insert(i + 1, start)
+        self._shift_offsets(i + 1, count)
+
+    def remove(self, doc_id):
+        """Remove the postings of doc_id, if any."""
+        i = self._find(doc_id)
+        if i is None:
+            return
+        start = self.offsets[i]
+        count = self.offsets[i + 1] - start
+        del self.doc_ids[i]
+        del self.positions[start:start + count]
+        del self.offsets[i + 1]
+        self._shift_offsets(i + 1, -count)
+
+    def _shift_offsets(self, start, delta):
+        """
+        Add delta to the offsets from index start on, in place with NumPy if
+        it is available, so that editing a long posting list does not loop on
+        its offsets in Python.
+        """
+        if start >= len(self.offsets) or not delta:
+            return
+        if numpy is not None:
+            # A view on the memory of the array, which is not resized while
+            # the view is used.
+            offsets = numpy.frombuffer(self.offsets, dtype=_UINT_DTYPE)[start:]
+            if delta > 0:
+                offsets += delta
+            else:
+                offsets -= -delta
+        else:
+            self.offsets[start:] = array('I', [offset + delta
+                                            for offset in self.offsets[start:]])
+
+    def get_count(self, doc_id):
+        """Return the number of occurrences of the token in doc_id."""
+        i = self._find(doc_id)
+        if i is None:
+            return 0
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def get_positions(self, doc_id):
+        """Return the positions of the token in doc_id, in an array."""
+        i = self._find(doc_id)
+        if i is None:
+            return array('I')
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def iter_postings(self):
+        """Iterate on the (doc_id, positions) pairs, by increasing doc id."""
+        for i, doc_id in enumerate(self.doc_ids):
+            yield doc_id, self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_json(self):
+        return [self.doc_ids.tolist(), self.offsets.tolist(),
+                self.positions.tolist()]
+
+
+if numpy is not None:
+    # The NumPy type of the items of the array('I') of the posting lists.
+    _UINT_DTYPE = numpy.dtype('u%d' % array('I').itemsize)
 
 
 class InvertedIndex(object):
     """
     An inverted index is a data set which links a term/word/token to all the
-    urls which contains that term/word/token and in which position in the text.
+    documents which contains that term/word/token and in which position in the
+    text.
 
     In practice, the inverted index is a dictionnary in which the keys are
-    the terms. The values are the url and the position of the terms in the
-    blob of text corresponding to the url:
+    the terms. The values are PostingList objects holding the doc ids of the
+    documents containing the terms and the position of the terms in the blob
+    of text corresponding to the document:
     self._index = {
-            'token': {
-                'url': [first_position, second_position],
-            },
+            'token': PostingList(doc_ids=[3, 8], positions=[[1, 12], [4]]),
             ...
         }
+    The doc ids are given by the Index, which maps them to the urls.
     """
     def __init__(self, json=None):
         """
@@ -252,80 +708,129 @@ class InvertedIndex(object):
         Notice that no security check is done to make sure that json is valid.
         """
         self._index = {}
+        # Length in tokens of the field of each document, by doc id, and their
+        # sum, for the scorers.
+        self._lengths = array('I')
+        self._total_length = 0
         if json:
-            self._index = json
+            for token, posting_list_json in json.iteritems():
+                self._index[token] = PostingList(posting_list_json)
 
-    def add_entry(self, url, token, position):
+    def add_entries(self, doc_id, tokens_and_positions):
         """
-        Add an entry in the InvertedIndex.
+        Add the entries of a document in the InvertedIndex.
 
-        position is an integer, position of the token in the blob of text
-        corresponding to the url.
+        tokens_and_positions is an iterable of (token, position) tuples,
+        position being the position of the token in the blob of text
+        corresponding to the document. The positions must be increasing.
         """
-        if not token in self._index:
-            self._index[token] = {url: [position]}
-        elif not url in self._index[token]:
-            self._index[token][url] = [position]
-        else:
-            self._index[token][url].append(position)
-
-    def remove_entry(self, url):
-        """Remove the data associated with an url."""
-        for urls in self._index.itervalues():
-            if url in urls:
-                del urls[url]
+        positions_by_token = {}
+        for token, position in tokens_and_positions:
+            positions_by_token.setdefault(token, []).append(position)
+        for token, positions in positions_by_token.iteritems():
+            posting_list = self._index.get(token)
+            if posting_list is None:
+                posting_list = self._index[token] = PostingList()
+            posting_list.add(doc_id, positions)
+
+    def remove_entry(self, doc_id, tokens_and_positions):
+        """
+        Remove the data associated with a document, whose entries are the
+        (token, position) tuples tokens_and_positions, as given to
+        add_entries(). Only the posting lists of its tokens are visited.
+        """
+        for token in set(token for token, position in tokens_and_positions):
+            posting_list = self._index.get(token)
+            if posting_list is None:
+                continue
+            posting_list.remove(doc_id)
+            if not len(posting_list):
+                del self._index[token]
 
     def get_entry_count(self):
         return len(self._index)
 
-    def get_urls_and_occurrences_for_token(self, token):
+    def set_length(self, doc_id, length):
+        """Set the length in tokens of the field of the document doc_id."""
+        if doc_id >= len(self._lengths):
+            self._lengths.extend([0] * (doc_id + 1 - len(self._lengths)))
+        self._total_length += length - self._lengths[doc_id]
+        self._lengths[doc_id] = length
+
+    def get_lengths(self):
+        """Return the array of the field lengths, by doc id."""
+        return self._lengths
+
+    def get_average_length(self):
+        if not self._lengths:
+            return 0.0
+        return float(self._total_length) / len(self._lengths)
+
+    def get_norms(self, k1, b):
+        """
+        Return the array of the BM25 norms of the field, by doc id, see
+        scoring.compute_norms(). The lengths change as documents are added,
+        so the norms are computed at each call.
+        """
+        return compute_norms(self._lengths, self.get_average_length(), k1, b)
+
+    def get_posting_list(self, token):
+        """Return the PostingList of token or None if token is not indexed."""
+        return self._index.get(token)
+
+    def get_doc_ids_and_occurrences_for_token(self, token):
         """"
-        Get the list of urls corresponding to token and the number of
-        occurrences of the token in the page. If token is not present in the
-        index, the returned list is empty
+        Get the list of doc ids corresponding to token and the number of
+        occurrences of the token in the document. If token is not present in
+        the index, the returned list is empty
         """
-        urls_and_occurrences = []
+        doc_ids_and_occurrences = []
         if token in self._index:
-            for url in self._index[token].keys():
-                urls_and_occurrences.append(url, len(self._index[token][url]))
-        return urls_and_occurrences
-
-    def get_matching_urls(self, token):
-        urls = set([])
+            posting_list = self._index[token]
+            for i, doc_id in enumerate(posting_list.doc_ids):
+                doc_ids_and_occurrences.append((doc_id,
+                        posting_list.offsets[i + 1] - posting_list.offsets[i]))
+        return doc_ids_and_occurrences
+
+    def get_matching_doc_ids(self, token):
+        """Return the sorted array of the ids of the documents containing token."""
         if token in self._index:
-            for url in self._index[token].keys():
-                urls.add(url)
-        return urls
+            return self._index[token].doc_ids
+        return array('I')
 
-    def get_matching_urls_count(self, token):
+    def get_matching_doc_count(self, token):
         if token in self._index:
             return len(self._index[token])
         else:
             return 0
 
-    def get_match_count_in_url(self, url, token):
-        count = 0
+    def get_match_count_in_doc(self, doc_id, token):
         if token in self._index:
-            if url in self._index[token]:
-                count = len(self._index[token][url])
-        return count
+            return self._index[token].get_count(doc_id)
+        return 0
 
-    def get_match_positions_in_url(self, url, token):
+    def get_match_positions_in_doc(self, doc_id, token):
         """
-        Return the list of matching positions of token in url.
+        Return the array of matching positions of token in the document doc_id.
         """
-        match_positions = []
         if token in self._index:
-            if url in self._index[token]:
-                match_positions = self._index[token][url]
-        return match_positions
+            return self._index[token].get_positions(doc_id)
+        return array('I')
+
+    def iter_terms(self):
+        """
+        Iterate on the (token, PostingList) pairs of the InvertedIndex in the
+        lexicographic order of the tokens.
+        """
+        for token in sorted(self._index):
+            yield token, self._index[token]
 
     def to_json(self):
-        return self._index
+        return dict((token, posting_list.to_json())
+                    for token, posting_list in self._index.iteritems())
 
     def __str__(self):
-        return str(self._index)
+        return str(self.to_json())
 
     def __repr__(self):
         return str(self.__dict__)
-
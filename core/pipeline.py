@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from analysis import Analyzer
+import blobprocessor
+from htmlutils import BananaHTMLParser, HTMLPage
+import multiprocessing
+import signal
+
+
+"""
+Module providing the tokenization of the crawled pages, possibly in a pool of
+processes working in parallel with the crawler and the indexing.
+"""
+
+
+class TokenizedPage(object):
+    """
+    The information of a page needed to index it: its url, title and full
+    text, their terms as (term, position) tuples and their numbers of words,
+    and the links of the page.
+    """
+    def __init__(self, url, title, text, analyzer, links=()):
+        """
+        Tokenize the title and the text of the page at url with analyzer, an
+        analysis.Analyzer. The meaningless characters are removed from text
+        first.
+        """
+        self.url = url
+        self.title = title
+        self.title_tokens = []
+        self.title_length = 0
+        if title:
+            self.title_tokens, self.title_length = analyzer.tokenize(title, True)
+        self.text = blobprocessor.remove_meaningless_chars(text)
+        self.text_tokens = []
+        self.text_length = 0
+        if self.text:
+            self.text_tokens, self.text_length = analyzer.tokenize(self.text, True)
+        self.links = links
+
+
+def tokenize_html(url, html, analyzer):
+    """
+    Parse the utf-8 encoded html code of the page at url and return its
+    TokenizedPage, tokenized with analyzer.
+    """
+    parser = BananaHTMLParser()
+    parser.feed_bytes(html)
+    parser.close()
+    page = HTMLPage(url, parser=parser)
+    return TokenizedPage(page.url, page.title, page.text, analyzer, page.links)
+
+
+# The analysis.Analyzer of a worker process of a Pipeline.
+_worker_analyzer = None
+
+
+def _init_worker(analyzer_settings):
+    """
+    Build the Analyzer of the worker process, and let the main process alone
+    handle the interruptions.
+    """
+    global _worker_analyzer
+    _worker_analyzer = Analyzer.from_json(analyzer_settings)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _tokenize_html_in_worker(url, html):
+    return tokenize_html(url, html, _worker_analyzer)
+
+
+class Pipeline(object):
+    """
+    Pool of processes parsing and tokenizing the fetched pages, so that this
+    CPU bound work runs on all the cores rather than in the process indexing
+    the pages.
+
+    tokenize() is meant to be called concurrently by the fetching threads of a
+    fetcher.Fetcher: each call waits for its page to be tokenized by one of the
+    processes, while the pages of the other threads are tokenized by the other
+    processes.
+    Usage:
+    pipeline = Pipeline(index.get_analyzer(), 4)
+    page = pipeline.tokenize('http://www.python.org', html)
+    pipeline.close()
+    """
+    def __init__(self, analyzer, process_count=None):
+        """
+        Start process_count processes, or as many as there are cores if it is
+        None, tokenizing the pages with an analysis.Analyzer with the same
+        settings as analyzer.
+        """
+        self._pool = multiprocessing.Pool(process_count, _init_worker,
+                                        (analyzer.to_json(),))
+
+    def tokenize(self, url, html):
+        """
+        Return the TokenizedPage of the page at url, given its utf-8 encoded
+        html code.
+        """
+        return self._pool.apply(_tokenize_html_in_worker, (url, html))
+
+    def close(self):
+        """Wait for the pages being tokenized and stop the processes."""
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,598 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from bisect import bisect_left
+import re
+import urlparse
+
+
+"""
+Module providing the parsing of the search queries and their evaluation over
+the posting lists.
+
+A query is made of operands, which the documents must all match:
+    python              A word, found in the title or in the full text.
+    "new york"          A phrase: the words must follow each other, in this
+                        order. The stop words of the phrase are not indexed,
+                        but still take their place between the other words.
+    python NEAR/5 web   A proximity clause: each word must be at most 5 words
+                        away from the first one, in any order. A plain NEAR
+                        allows Near.DEFAULT_DISTANCE words.
+    site:python.org     The url of the document must be on this host or on
+                        one of its subdomains.
+    python OR ruby      Either operand, OR binding tighter than the implicit
+                        AND: 'web python OR ruby' requires web.
+    -java               The documents matching the operand are excluded.
+AND may be written between two operands, it is the default anyway.
+
+A parsed query is evaluated by an iterator tree over the sorted doc ids of
+the posting lists, see make_iterator().
+"""
+
+
+# The quoted phrases, possibly excluded or left open, and the other words of
+# a query.
+QUERY_PATTERN = re.compile(r'(-?)"([^"]*)"?|([^\s"]+)', re.UNICODE)
+# The NEAR operator and its optional distance.
+NEAR_PATTERN = re.compile(r'NEAR(?:/(\d+))?$')
+SITE_PREFIX = 'site:'
+
+
+class Query(object):
+    """
+    A parsed search query: its tree of operands, root, which is None if the
+    query cannot match any document, the terms of the words which are not
+    excluded, which score the documents as a bag of words, and the Phrase
+    and Near clauses which are not excluded, which boost the documents
+    matching them.
+    """
+    def __init__(self, root, terms, clauses):
+        self.root = root
+        self.terms = terms
+        self.clauses = clauses
+
+    def get_key(self):
+        """
+        Return a hashable value which is the same for the queries parsed to
+        the same tree of operands, for instance 'Searching -java' and
+        'searched -Java' with a stemming analyzer.
+        """
+        if self.root is None:
+            return None
+        return self.root.get_key()
+
+    def is_disjunction(self):
+        """
+        Return whether the query is a single word or words joined by OR, in
+        which case any document matching a term is a result.
+        """
+        if isinstance(self.root, Term):
+            return True
+        return (isinstance(self.root, Or) and
+                all(isinstance(child, Term) for child in self.root.children))
+
+
+class Term(object):
+    """Operand matching the documents containing the term."""
+    def __init__(self, term):
+        self.term = term
+
+    def get_key(self):
+        return self.term
+
+
+class Phrase(object):
+    """
+    Operand matching the documents in which the terms are found at the given
+    offsets from each other, as in a quoted phrase.
+    """
+    def __init__(self, terms_and_offsets):
+        """
+        terms_and_offsets is the list of the (term, offset) tuples of the
+        phrase, offset being the position of the word of the term in the
+        phrase.
+        """
+        self._terms_and_offsets = terms_and_offsets
+        self.terms = sorted(set(term for term, offset in terms_and_offsets))
+
+    def get_key(self):
+        return ('phrase', tuple(self._terms_and_offsets))
+
+    def count_matches(self, positions_by_term):
+        """
+        Return the number of occurrences of the phrase in a field, given the
+        sorted positions of each of its terms in the field.
+        """
+        # Try the starts given by the rarest term of the phrase.
+        terms_and_offsets = sorted(self._terms_and_offsets,
+                                key=lambda item: len(positions_by_term[item[0]]))
+        first_term, first_offset = terms_and_offsets[0]
+        count = 0
+        for position in positions_by_term[first_term]:
+            start = position - first_offset
+            if start < 0:
+                continue
+            for term, offset in terms_and_offsets[1:]:
+                if not _contains(positions_by_term[term], start + offset):
+                    break
+            else:
+                count += 1
+        return count
+
+
+class Near(object):
+    """
+    Operand matching the documents in which each term is found at most
+    distance words away from the first term, before or after it.
+    """
+    DEFAULT_DISTANCE = 10
+
+    def __init__(self, terms, distance=DEFAULT_DISTANCE):
+        self.terms = terms
+        self._distance = distance
+
+    def get_key(self):
+        return ('near', tuple(self.terms), self._distance)
+
+    def count_matches(self, positions_by_term):
+        """
+        Return the number of occurrences of the first term which have all the
+        other terms near them in a field, given the sorted positions of the
+        terms in the field.
+        """
+        distance = self._distance
+        other_positions = [positions_by_term[term] for term in self.terms[1:]]
+        count = 0
+        for position in positions_by_term[self.terms[0]]:
+            for positions in other_positions:
+                i = bisect_left(positions, position - distance)
+                if i == len(positions) or positions[i] > position + distance:
+                    break
+            else:
+                count += 1
+        return count
+
+
+class Site(object):
+    """Operand matching the documents whose url is on host or below it."""
+    def __init__(self, host):
+        self.host = host.lower()
+
+    def get_key(self):
+        return ('site', self.host)
+
+    def matches(self, url):
+        host = (urlparse.urlsplit(url).hostname or '').lower()
+        return host == self.host or host.endswith('.' + self.host)
+
+
+class Or(object):
+    """Operand matching the documents matching any of its children."""
+    def __init__(self, children):
+        self.children = children
+
+    def get_key(self):
+        return ('or',) + tuple(child.get_key() for child in self.children)
+
+
+class And(object):
+    """
+    Operand matching the documents matching all its children and none of its
+    excluded operands.
+    """
+    def __init__(self, children, excluded):
+        self.children = children
+        self.excluded = excluded
+
+    def get_key(self):
+        return ('and', tuple(child.get_key() for child in self.children),
+                tuple(child.get_key() for child in self.excluded))
+
+
+def parse_query(query, analyzer):
+    """
+    Parse the query string and return its Query, analyzing its words with
+    the analysis.Analyzer analyzer. The words left without term by the
+    analyzer, such as the stop words, are ignored.
+    """
+    # The (excluded, operand) tuples of the implicit AND.
+    operands = []
+    # Whether the next operand is excluded, is joined to the previous one by
+    # OR, and the distance of the NEAR operator before it, if any.
+    excluded = False
+    is_or = False
+    distance = None
+    for match in QUERY_PATTERN.finditer(query):
+        minus, phrase, word = match.groups()
+        operand = None
+        if phrase is not None:
+            excluded = bool(minus)
+            terms_and_offsets = analyzer.tokenize(phrase)[0]
+            if terms_and_offsets:
+                operand = Phrase(terms_and_offsets)
+        elif word == 'OR':
+            is_or = True
+            continue
+        elif word == 'AND':
+            continue
+        elif NEAR_PATTERN.match(word):
+            distance = int(NEAR_PATTERN.match(word).group(1) or
+                        Near.DEFAULT_DISTANCE)
+            continue
+        else:
+            if word.startswith('-'):
+                excluded = True
+                word = word[1:]
+            if word.startswith(SITE_PREFIX) and len(word) > len(SITE_PREFIX):
+                operand = Site(word[len(SITE_PREFIX):])
+            else:
+                terms = analyzer.make_terms(word)
+                if terms:
+                    operand = Term(terms[0])
+
+        if operand is not None:
+            previous_excluded, previous = operands[-1] if operands else (True, None)
+            if (distance is not None and not excluded and not previous_excluded
+                    and isinstance(operand, Term)
+                    and isinstance(previous, (Term, Near))):
+                # A chain of NEAR operators makes a single clause, whose
+                # distance is the one of its first operator.
+                if isinstance(previous, Term):
+                    previous = Near([previous.term], distance)
+                previous.terms.append(operand.term)
+                operands[-1] = (False, previous)
+            elif is_or and excluded == previous_excluded and previous:
+                if not isinstance(previous, Or):
+                    previous = Or([previous])
+                previous.children.append(operand)
+                operands[-1] = (excluded, previous)
+            else:
+                operands.append((excluded, operand))
+        excluded = is_or = False
+        distance = None
+
+    children = [operand for excluded, operand in operands if not excluded]
+    excluded = [operand for excluded, operand in operands if excluded]
+    terms = []
+    clauses = []
+    for operand in children:
+        _collect_terms_and_clauses(operand, terms, clauses)
+    if not children:
+        # Excluding documents from nothing.
+        root = None
+    elif len(children) == 1 and not excluded:
+        root = children[0]
+    else:
+        root = And(children, excluded)
+    return Query(root, terms, clauses)
+
+
+def _collect_terms_and_clauses(operand, terms, clauses):
+    """Add the terms and the clauses of operand to terms and clauses."""
+    if isinstance(operand, Term):
+        terms.append(operand.term)
+    elif isinstance(operand, (Phrase, Near)):
+        terms.extend(operand.terms)
+        clauses.append(operand)
+    elif isinstance(operand, Or):
+        for child in operand.children:
+            _collect_terms_and_clauses(child, terms, clauses)
+
+
+def make_iterator(operand, field_indexes, document_count, get_url):
+    """
+    Return the iterator on the sorted ids of the documents matching operand.
+
+    field_indexes are the objects whose get_posting_list(term) method gives
+    the index.PostingList of term in each field, document_count the number of
+    documents and get_url(doc_id) returns the url of a document.
+
+    The iterators of the terms walk the doc ids of their posting lists and
+    the iterators of the operators combine their children: an AND lets its
+    rarest child lead and the others skip to its documents, so it costs
+    about as much as its rarest child. The posting lists being arrays,
+    skipping is done by galloping in them rather than by following skip
+    pointers.
+    """
+    if isinstance(operand, Term):
+        return _make_or_iterator([_PostingIterator(posting_list)
+                for posting_list in _get_posting_lists(field_indexes, operand.term)
+                if posting_list])
+    if isinstance(operand, (Phrase, Near)):
+        # The clause may be matched in any field, by the positions of its
+        # terms in the documents containing all of them in that field.
+        iterators = []
+        for field_index in field_indexes:
+            posting_lists = [field_index.get_posting_list(term)
+                            for term in operand.terms]
+            if all(posting_lists):
+                iterators.append(_FilterIterator(
+                        _AndIterator([_PostingIterator(posting_list)
+                                    for posting_list in posting_lists]),
+                        _make_clause_predicate(operand, posting_lists)))
+        return _make_or_iterator(iterators)
+    if isinstance(operand, Site):
+        return _FilterIterator(_RangeIterator(document_count),
+                            lambda doc_id: operand.matches(get_url(doc_id)))
+    if isinstance(operand, Or):
+        return _make_or_iterator([make_iterator(child, field_indexes,
+                document_count, get_url) for child in operand.children])
+
+    # The sites of an AND filter the documents of its other children, rather
+    # than leading the iteration over all the documents.
+    sites = [child for child in operand.children if isinstance(child, Site)]
+    children = [child for child in operand.children if not isinstance(child, Site)]
+    if children:
+        iterator = _AndIterator([make_iterator(child, field_indexes,
+                document_count, get_url) for child in children])
+    else:
+        iterator = _RangeIterator(document_count)
+    excluded_sites = [child for child in operand.excluded if isinstance(child, Site)]
+    excluded = [child for child in operand.excluded if not isinstance(child, Site)]
+    if excluded:
+        iterator = _AndNotIterator(iterator, _make_or_iterator([make_iterator(
+                child, field_indexes, document_count, get_url) for child in excluded]))
+    if sites or excluded_sites:
+        def predicate(doc_id):
+            url = get_url(doc_id)
+            return (all(site.matches(url) for site in sites) and
+                    not any(site.matches(url) for site in excluded_sites))
+        iterator = _FilterIterator(iterator, predicate)
+    return iterator
+
+
+def get_clause_positions(clause, field_index, doc_id):
+    """
+    Return the dict of the positions of the terms of the clause in the field
+    of doc_id, or None if a term is not in the field of doc_id.
+    """
+    positions_by_term = {}
+    for term in clause.terms:
+        posting_list = field_index.get_posting_list(term)
+        if posting_list is None:
+            return None
+        positions = posting_list.get_positions(doc_id)
+        if not positions:
+            return None
+        positions_by_term[term] = positions
+    return positions_by_term
+
+
+def _get_posting_lists(field_indexes, term):
+    return [field_index.get_posting_list(term) for field_index in field_indexes]
+
+
+def _make_clause_predicate(clause, posting_lists):
+    """
+    Return the function telling whether a document containing all the terms
+    of the clause in the fields of posting_lists matches the clause.
+    """
+    def predicate(doc_id):
+        positions_by_term = dict((term, posting_list.get_positions(doc_id))
+                for term, posting_list in zip(clause.terms, posting_lists))
+        return clause.count_matches(positions_by_term) > 0
+    return predicate
+
+
+def _make_or_iterator(iterators):
+    if not iterators:
+        return _EmptyIterator()
+    if len(iterators) == 1:
+        return iterators[0]
+    return _OrIterator(iterators)
+
+
+def _contains(array, value):
+    """Return whether the sorted array contains value."""
+    i = bisect_left(array, value)
+    return i < len(array) and array[i] == value
+
+
+def gallop(array, value, low=0):
+    """
+    Return the index of the first item of the sorted array which is at least
+    value, or len(array), looking from index low with exponentially growing
+    steps, so that the cost depends on the distance to the item rather than on
+    the size of the array.
+    """
+    length = len(array)
+    high = low
+    step = 1
+    while high < length and array[high] < value:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(array, value, low, min(high, length))
+
+
+# The iterators of the documents matching an operand. Each one is on the
+# document doc_id, None once all the documents are visited, and has:
+#     cost        An upper bound of the number of documents it visits.
+#     next()      Move to the next matching document.
+#     advance(d)  Move to the first matching document whose id is at least d.
+# Both methods only move forward.
+
+
+class _PostingIterator(object):
+    """Iterator on the doc ids of a posting list."""
+    __slots__ = ('cost', 'doc_id', '_doc_ids', '_index')
+
+    def __init__(self, posting_list):
+        self._doc_ids = posting_list.doc_ids
+        self.cost = len(self._doc_ids)
+        self._index = -1
+        self.doc_id = None
+        self.next()
+
+    def next(self):
+        self._index += 1
+        if self._index < self.cost:
+            self.doc_id = self._doc_ids[self._index]
+        else:
+            self.doc_id = None
+
+    def advance(self, doc_id):
+        if self.doc_id is None or self.doc_id >= doc_id:
+            return
+        self._index = gallop(self._doc_ids, doc_id, self._index)
+        if self._index < self.cost:
+            self.doc_id = self._doc_ids[self._index]
+        else:
+            self.doc_id = None
+
+
+class _RangeIterator(object):
+    """Iterator on all the doc ids, from 0 to count - 1."""
+    def __init__(self, count):
+        self.cost = count
+        self.doc_id = 0 if count else None
+
+    def next(self):
+        self.advance(self.doc_id + 1)
+
+    def advance(self, doc_id):
+        if self.doc_id is None or self.doc_id >= doc_id:
+            return
+        self.doc_id = doc_id if doc_id < self.cost else None
+
+
+class _AndIterator(object):
+    """Iterator on the documents of all its children."""
+    def __init__(self, children):
+        # The rarest child leads, the others are advanced to its documents.
+        self._children = sorted(children, key=lambda child: child.cost)
+        self.cost = self._children[0].cost
+        self._align()
+
+    def _align(self):
+        """Move the children forward to their first common document."""
+        lead = self._children[0]
+        others = self._children[1:]
+        doc_id = lead.doc_id
+        while doc_id is not None:
+            for child in others:
+                child.advance(doc_id)
+                if child.doc_id != doc_id:
+                    if child.doc_id is None:
+                        doc_id = None
+                    else:
+                        lead.advance(child.doc_id)
+                        doc_id = lead.doc_id
+                    break
+            else:
+                break
+        self.doc_id = doc_id
+
+    def next(self):
+        self._children[0].next()
+        self._align()
+
+    def advance(self, doc_id):
+        if self.doc_id is None or self.doc_id >= doc_id:
+            return
+        self._children[0].advance(doc_id)
+        self._align()
+
+
+class _OrIterator(object):
+    """Iterator on the documents of any of its children."""
+    def __init__(self, children):
+        self._children = children
+        self.cost = sum(child.cost for child in children)
+        self._update()
+
+    def _update(self):
+        doc_ids = [child.doc_id for child in self._children
+                if child.doc_id is not None]
+        self.doc_id = min(doc_ids) if doc_ids else None
+
+    def next(self):
+        doc_id = self.doc_id
+        for child in self._children:
+            if child.doc_id == doc_id:
+                child.next()
+        self._update()
+
+    def advance(self, doc_id):
+        if self.doc_id is None or self.doc_id >= doc_id:
+            return
+        for child in self._children:
+            child.advance(doc_id)
+        self._update()
+
+
+class _AndNotIterator(object):
+    """Iterator on the documents of child which are not in excluded."""
+    def __init__(self, child, excluded):
+        self._child = child
+        self._excluded = excluded
+        self.cost = child.cost
+        self._skip_excluded()
+
+    def _skip_excluded(self):
+        child = self._child
+        while child.doc_id is not None:
+            self._excluded.advance(child.doc_id)
+            if self._excluded.doc_id != child.doc_id:
+                break
+            child.next()
+        self.doc_id = child.doc_id
+
+    def next(self):
+        self._child.next()
+        self._skip_excluded()
+
+    def advance(self, doc_id):
+        self._child.advance(doc_id)
+        self._skip_excluded()
+
+
+class _FilterIterator(object):
+    """Iterator on the documents of child for which predicate is True."""
+    def __init__(self, child, predicate):
+        self._child = child
+        self._predicate = predicate
+        self.cost = child.cost
+        self._skip_rejected()
+
+    def _skip_rejected(self):
+        child = self._child
+        while child.doc_id is not None and not self._predicate(child.doc_id):
+            child.next()
+        self.doc_id = child.doc_id
+
+    def next(self):
+        self._child.next()
+        self._skip_rejected()
+
+    def advance(self, doc_id):
+        if self.doc_id is None or self.doc_id >= doc_id:
+            return
+        self._child.advance(doc_id)
+        self._skip_rejected()
+
+
+class _EmptyIterator(object):
+    """Iterator on no document."""
+    cost = 0
+    doc_id = None
+
+    def next(self):
+        pass
+
+    def advance(self, doc_id):
+        pass
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from array import array
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+"""
+Module providing the relevance scorers of the Searcher.
+
+When NumPy is available, the scorers can also score whole posting lists with
+vectorized operations, see BM25Scorer.find_top_documents().
+"""
+
+
+class BM25Scorer(object):
+    """
+    Okapi BM25 scorer over the title and full text fields of an index.
+
+    The score of a document d for the query tokens t is:
+        sum over the fields f of
+            weight(f) * sum over t of
+                idf(f, t) * tf(f, t, d) * (k1 + 1) / (tf(f, t, d) + norm(f, d))
+    with
+        idf(f, t) = log(1 + (N - n(f, t) + 0.5) / (n(f, t) + 0.5))
+        norm(f, d) = k1 * (1 - b + b * length(f, d) / average_length(f))
+    where N is the number of documents, n(f, t) the number of documents
+    containing t in the field f and tf(f, t, d) the number of occurrences of t
+    in the field f of d.
+
+    The phrase and proximity clauses of a query add a proximity boost to the
+    documents matching them: in each field, the clause is scored like a term
+    whose occurrences are the matches of the clause and whose idf is the sum
+    of the idfs of its terms, times proximity_weight.
+
+    A scorer is built when an index is loaded. The norms of the documents are
+    precomputed by the index, see compute_norms(). The idf of a term is
+    computed once, the first time it is needed.
+    """
+    K1 = 1.2
+    B = 0.75
+    TITLE_WEIGHT = 2.0
+    FULL_TEXT_WEIGHT = 1.0
+    PROXIMITY_WEIGHT = 1.0
+
+    def __init__(self, index, k1=K1, b=B, title_weight=TITLE_WEIGHT,
+                full_text_weight=FULL_TEXT_WEIGHT,
+                proximity_weight=PROXIMITY_WEIGHT):
+        """
+        Build a BM25Scorer for the index.Index or segment.SegmentIndex index.
+        """
+        self.k1 = k1
+        self.b = b
+        self.proximity_weight = proximity_weight
+        document_count = index.get_indexed_url_count()
+        self._field_scorers = (
+                FieldScorer(index.get_title_index(), document_count, k1, b, title_weight),
+                FieldScorer(index.get_full_text_index(), document_count, k1, b, full_text_weight))
+
+    def get_field_scorers(self):
+        """Return the FieldScorer objects of the title and of the full text."""
+        return self._field_scorers
+
+    def find_top_documents(self, token_counts, count):
+        """
+        Return the (score, doc_id) tuples of the count most relevant
+        documents for the query tokens, by decreasing score. token_counts is
+        a dict giving the number of times each token is in the query.
+
+        All the documents matching a token are scored, with NumPy vectorized
+        operations, which is only available if NumPy is installed.
+        """
+        doc_id_arrays = []
+        score_arrays = []
+        for field_scorer in self._field_scorers:
+            for token, token_count in token_counts.iteritems():
+                posting_list = field_scorer.get_posting_list(token)
+                if posting_list:
+                    weight = field_scorer.get_weight(token, token_count)
+                    doc_ids, scores = field_scorer.score_posting_list_vectorized(weight, posting_list)
+                    doc_id_arrays.append(doc_ids)
+                    score_arrays.append(scores)
+        if not doc_id_arrays:
+            return []
+
+        # Sum the scores of each document over the tokens and fields.
+        doc_ids, inverse = numpy.unique(numpy.concatenate(doc_id_arrays),
+                                        return_inverse=True)
+        scores = numpy.zeros(len(doc_ids))
+        numpy.add.at(scores, inverse, numpy.concatenate(score_arrays))
+
+        # Select the count best documents without sorting all of them, then
+        # sort these by decreasing score and doc id.
+        if count < len(scores):
+            top = numpy.argpartition(-scores, count - 1)[:count]
+            doc_ids = doc_ids[top]
+            scores = scores[top]
+        order = numpy.lexsort((doc_ids, scores))[::-1]
+        return [(float(scores[i]), int(doc_ids[i])) for i in order]
+
+
+class FieldScorer(object):
+    """
+    BM25 scorer for one field of an index, see BM25Scorer.
+    """
+    def __init__(self, inverted_index, document_count, k1, b, weight):
+        self._inverted_index = inverted_index
+        self._document_count = document_count
+        self.k1 = k1
+        self.weight = weight
+        # The idf of the terms, by term.
+        self._idfs = {}
+        # The norms of the documents, by doc id.
+        self._norms = inverted_index.get_norms(k1, b)
+        if numpy is not None:
+            # A view on the same memory.
+            self._numpy_norms = self._norms
+            if isinstance(self._norms, array):
+                self._numpy_norms = numpy.frombuffer(self._norms, dtype=numpy.float64)
+
+    def get_posting_list(self, token):
+        return self._inverted_index.get_posting_list(token)
+
+    def get_idf(self, token):
+        """Return the inverse document frequency of token in the field."""
+        idf = self._idfs.get(token)
+        if idf is None:
+            n = self._inverted_index.get_matching_doc_count(token)
+            N = self._document_count
+            idf = self._idfs[token] = math.log(1.0 + (N - n + 0.5) / (n + 0.5))
+        return idf
+
+    def get_weight(self, token, query_count=1):
+        """
+        Return the weight of token in the scores: its idf, times the weight of
+        the field and the number of times the token is in the query.
+        """
+        return query_count * self.weight * self.get_idf(token)
+
+    def get_upper_bound(self, weight):
+        """
+        Return the highest score a token of weight 'weight' can give to a
+        document, tf / (tf + norm) being below 1.
+        """
+        return weight * (self.k1 + 1.0)
+
+    def score(self, weight, frequency, doc_id):
+        """
+        Return the score of a token of weight 'weight' occurring frequency times
+        in the field of the document doc_id.
+        """
+        return weight * frequency * (self.k1 + 1.0) / (frequency +
+                                                    float(self._norms[doc_id]))
+
+    def score_posting_list_vectorized(self, weight, posting_list):
+        """
+        Score all the documents of a posting list with NumPy, for a token of
+        weight 'weight', and return the array of their doc ids and the array
+        of their scores.
+        """
+        doc_ids = numpy.frombuffer(posting_list.doc_ids, dtype=_UINT_DTYPE)
+        frequencies = numpy.diff(numpy.frombuffer(posting_list.offsets,
+                                                dtype=_UINT_DTYPE)).astype(numpy.float64)
+        scores = (weight * (self.k1 + 1.0) * frequencies /
+                (frequencies + self._numpy_norms[doc_ids]))
+        return doc_ids, scores
+
+
+def compute_norms(lengths, average_length, k1=BM25Scorer.K1, b=BM25Scorer.B):
+    """
+    Return the array('d') of the BM25 norms of the documents whose field
+    lengths are lengths, by doc id, see BM25Scorer.
+    """
+    constant = k1 * (1.0 - b)
+    factor = k1 * b / (average_length or 1.0)
+    return array('d', [constant + factor * length for length in lengths])
+
+
+if numpy is not None:
+    # The NumPy type of the items of the array('I') of the posting lists.
+    _UINT_DTYPE = numpy.dtype('u%d' % array('I').itemsize)
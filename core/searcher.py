@@ -15,12 +15,18 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with banana.  If not, see <http://www.gnu.org/licenses/>.
-import blobprocessor
+from bisect import bisect_left
+from cache import LRUCache
+import heapq
 from index import Index
 import logging
-import math
+from operator import attrgetter
 import os
+import query as query_parser
+import scoring
+from segment import SegmentIndex
 import sys
+import threading
 
 
 class Searcher(object):
@@ -28,10 +34,19 @@ class Searcher(object):
     Allows to search within an inverted index Index object from the index
     module.
     """
-    def __init__(self, index_filename='index.json'):
+    # Above this number of postings to visit for a query, the documents are
+    # scored with NumPy if it is available, rather than with WAND.
+    VECTORIZED_SCORING_MIN_POSTING_COUNT = 20000
+
+    def __init__(self, index_filename=Index.FILENAME, **scoring_parameters):
         """
         Build a Searcher object, load the inverted index from
-        'index_filename' file.
+        'index_filename' file, or open it if 'index_filename' is a segment
+        directory written by segment.write_index().
+
+        The index is opened read only, so deleting the Searcher does not write
+        the index back to the disk. The optional scoring_parameters are passed
+        to the scoring.BM25Scorer, for instance k1, b or title_weight.
         """
         # Get a logger assuming that the logging facility has been set up by the
         # banana module.
@@ -43,113 +58,419 @@ class Searcher(object):
                     'no index file %s in the current directory.' % index_filename)
             sys.exit(0)
         else:
-            self._index = Index(index_filename)
+            # Read the generation before loading, so that an index dumped while
+            # we are loading is seen as newer than ours.
+            self._generation = get_index_generation(index_filename)
+            if os.path.isdir(index_filename):
+                self._index = SegmentIndex(index_filename)
+            else:
+                self._index = Index(True, index_filename, read_only=True)
+            # The scorer precomputes its statistics once per loaded index.
+            self._scorer = scoring.BM25Scorer(self._index, **scoring_parameters)
+
+    def get_stats(self):
+        """
+        Return the dict of the statistics of the index, such as those of its
+        posting lists cache.
+        """
+        return {'postings_cache': self._index.get_cache_stats()}
+
+    def get_generation(self):
+        """
+        Return the generation of the index file this Searcher was loaded from.
+        """
+        return self._generation
+
+    def query(self, query, limit=10, offset=0, snippets=True):
+        """
+        Return the list of the Answer objects of rank offset to offset + limit
+        for query, by decreasing relevance score. See the query module for the
+        syntax of query.
 
-    def query(self, query):
+        If snippets is False, the answers have no snippet, which saves reading
+        the texts of their documents.
+        """
+        return self.run_query(self.parse_query(query), limit, offset, snippets)
+
+    def parse_query(self, query):
+        """Return the query.Query of the query string."""
         # Make sure this is not an empty query.
         if not query:
             raise Exception('Invalid query \"%s\" in Searcher.query().' % query)
-        #TODO add weights for the title and full text scores.
-        tokenized_query = blobprocessor.make_tokens(query)
+        return query_parser.parse_query(query, self._index.get_analyzer())
 
-        # Compute title relevance score.
-        # Get urls with title matching query.
-        matching_urls = set([])
-        title_index = self._index.get_title_index()
-        for token in tokenized_query:
-            for url in title_index.get_matching_urls(token):
-                self._logger.debug(self._index.get_title(url))
-                matching_urls.add(url)
-
-        urls_and_score = {}
-        for url in matching_urls:
-            score = self.compute_bm25_relevance(url, tokenized_query, title_index)
-            self._logger.debug('Title score for url %s: %f' % (url, score))
-            urls_and_score[url] = score
-
-        # Compute full text relevance score.
-        # Get urls with full text matching query.
-        matching_urls = set([])
-        full_text_index = self._index.get_full_text_index()
-        for token in tokenized_query:
-            for url in full_text_index.get_matching_urls(token):
-                matching_urls.add(url)
-
-        for url in matching_urls:
-            score = self.compute_bm25_relevance(url, tokenized_query,
-                                                full_text_index)
-            self._logger.debug('Full text score for url %s: %f' % (url, score))
-            if url in urls_and_score:
-                urls_and_score[url] += score
-            else:
-                urls_and_score[url] = score
+    def run_query(self, parsed_query, limit=10, offset=0, snippets=True):
+        """
+        Same as query(), for the query.Query parsed_query returned by
+        parse_query().
+        """
+        tokenized_query = parsed_query.terms
 
-        # Sort the ranked urls.
-        score_sorted_urls = sorted(urls_and_score.items(),
-                                key=lambda (k,v):(v,k), reverse=True)
-        self._logger.debug(score_sorted_urls)
+        # Only the documents of the requested page get an Answer. The
+        # documents matching any term of a disjunction are ranked by WAND or
+        # vectorized scoring, the others are found by an iterator tree.
+        if parsed_query.root is None:
+            score_sorted_doc_ids = []
+        elif parsed_query.is_disjunction():
+            score_sorted_doc_ids = self._find_top_documents(tokenized_query,
+                                                            offset + limit)
+        else:
+            score_sorted_doc_ids = self._find_top_matching_documents(
+                    parsed_query, offset + limit)
+        self._logger.debug(score_sorted_doc_ids)
 
         # Build the Answer objects that will be returned.
         answers = []
         context_before = 5
         context_after = 8
         max_match_count = 5
-        for url_and_score in score_sorted_urls:
-            url = url_and_score[0]
-            score = url_and_score[1]
-
-            title = self._index.get_title(url)
-            title_highlights = self._find_highlights(tokenized_query, title)
+        for score, doc_id in score_sorted_doc_ids[offset:offset + limit]:
+            url = self._index.get_url(doc_id)
+            title = self._index.get_title(doc_id)
+            title_highlights = self._find_title_highlights(doc_id,
+                                                        tokenized_query)
 
-            snippet = self._index.make_snippet(url, tokenized_query,
-                                            context_before, context_after,
-                                            max_match_count)
-            snippet_highlights = self._find_highlights(tokenized_query, snippet)
+            # The snippet comes with its highlights.
+            snippet, snippet_highlights = None, []
+            if snippets:
+                snippet, snippet_highlights = self._index.make_snippet(doc_id,
+                        tokenized_query, context_before, context_after,
+                        max_match_count)
 
             # Add an Answer object to the answers collection.
             answers.append(Answer(url, score, title, title_highlights, snippet,
                                     snippet_highlights))
         return answers
 
-    def _find_highlights(self, tokens, snippet):
+    def _find_top_documents(self, tokens, count):
         """
-        Build the highlights positions by parsing the given snippet.
+        Return the (score, doc_id) tuples of the count most relevant
+        documents for the query tokens, by decreasing score.
 
-        The parsing is case insensitive. These positions are useful for instance
-        to highlight the matching words in the snippet.
+        The documents are scored with the WAND algorithm: a cursor walks the
+        posting list of each token in each field, in the order of the doc ids,
+        and each cursor knows an upper bound of the score it can contribute.
+        A document whose cursors' upper bounds cannot reach the score of the
+        current count-th best document is skipped without being scored, and
+        the best documents are kept in a heap of size count.
         """
-        highlights = []
+        token_counts = {}
         for token in tokens:
-            for position, word in enumerate(snippet.split()):
-                if token.lower() in word.lower():
-                    highlights.append(position)
-        return highlights
+            token_counts[token] = token_counts.get(token, 0) + 1
+
+        # On large posting lists, scoring every document with vectorized
+        # operations is faster than skipping some of them in Python.
+        if scoring.numpy is not None:
+            posting_count = 0
+            for field_scorer in self._scorer.get_field_scorers():
+                for token in token_counts:
+                    posting_list = field_scorer.get_posting_list(token)
+                    if posting_list:
+                        posting_count += len(posting_list)
+            if posting_count >= Searcher.VECTORIZED_SCORING_MIN_POSTING_COUNT:
+                return self._scorer.find_top_documents(token_counts, count)
+
+        cursors = []
+        for field_scorer in self._scorer.get_field_scorers():
+            for token, token_count in token_counts.iteritems():
+                posting_list = field_scorer.get_posting_list(token)
+                if posting_list:
+                    weight = field_scorer.get_weight(token, token_count)
+                    cursors.append(_TermCursor(field_scorer, posting_list, weight))
+
+        top_documents = []
+        while cursors:
+            cursors.sort(key=attrgetter('doc_id'))
 
-    def compute_bm25_relevance(self, url, query_tokens, index):
+            # Find the pivot, the first cursor at which the accumulated upper
+            # bounds may beat the worst of the top documents. The documents
+            # before the pivot document cannot.
+            threshold = None
+            if len(top_documents) >= count:
+                threshold = top_documents[0][0]
+            pivot = None
+            bound = 0
+            for i, cursor in enumerate(cursors):
+                bound += cursor.upper_bound
+                if threshold is None or bound >= threshold:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            pivot_doc_id = cursors[pivot].doc_id
+
+            if cursors[0].doc_id == pivot_doc_id:
+                # All the cursors up to the pivot are on the pivot document,
+                # fully score it.
+                matching_cursors = [cursor for cursor in cursors
+                                    if cursor.doc_id == pivot_doc_id]
+                document = (self._compute_score(matching_cursors), pivot_doc_id)
+                if len(top_documents) < count:
+                    heapq.heappush(top_documents, document)
+                elif document > top_documents[0]:
+                    heapq.heapreplace(top_documents, document)
+                for cursor in matching_cursors:
+                    cursor.next()
+            else:
+                for cursor in cursors[:pivot]:
+                    cursor.advance(pivot_doc_id)
+            cursors = [cursor for cursor in cursors if cursor.doc_id is not None]
+
+        return sorted(top_documents, reverse=True)
+
+    def _find_top_matching_documents(self, parsed_query, count):
+        """
+        Return the (score, doc_id) tuples of the count most relevant
+        documents matching the query.Query parsed_query, by decreasing score.
+
+        The matching documents are generated by the iterator tree of the
+        query, so a conjunctive query only visits about as many documents as
+        its rarest operand has. Each of them is scored with the BM25 scores of
+        the query terms it contains, plus the proximity boost of the phrase
+        and proximity clauses it matches.
+        """
+        field_scorers = self._scorer.get_field_scorers()
+        iterator = query_parser.make_iterator(parsed_query.root, field_scorers,
+                self._index.get_indexed_url_count(), self._index.get_url)
+
+        # The posting lists and weights of the terms, and the proximity
+        # weights of the clauses, in each field.
+        token_counts = {}
+        for token in parsed_query.terms:
+            token_counts[token] = token_counts.get(token, 0) + 1
+        weighted_posting_lists = []
+        weighted_clauses = []
+        proximity_weight = self._scorer.proximity_weight
+        for field_scorer in field_scorers:
+            for token, token_count in token_counts.iteritems():
+                posting_list = field_scorer.get_posting_list(token)
+                if posting_list:
+                    weighted_posting_lists.append((field_scorer, posting_list,
+                            field_scorer.get_weight(token, token_count)))
+            for clause in parsed_query.clauses:
+                weighted_clauses.append((field_scorer, clause, proximity_weight *
+                        sum(field_scorer.get_weight(term) for term in clause.terms)))
+
+        top_documents = []
+        while iterator.doc_id is not None:
+            doc_id = iterator.doc_id
+            score = 0.0
+            for field_scorer, posting_list, weight in weighted_posting_lists:
+                frequency = posting_list.get_count(doc_id)
+                if frequency:
+                    score += field_scorer.score(weight, frequency, doc_id)
+            for field_scorer, clause, weight in weighted_clauses:
+                positions_by_term = query_parser.get_clause_positions(clause,
+                        field_scorer, doc_id)
+                if positions_by_term:
+                    match_count = clause.count_matches(positions_by_term)
+                    if match_count:
+                        score += field_scorer.score(weight, match_count, doc_id)
+            document = (score, doc_id)
+            if len(top_documents) < count:
+                heapq.heappush(top_documents, document)
+            elif document > top_documents[0]:
+                heapq.heapreplace(top_documents, document)
+            iterator.next()
+        return sorted(top_documents, reverse=True)
+
+    def _compute_score(self, cursors):
+        """
+        Compute the relevance score of the document on which all the cursors
+        are, summing the BM25 scores of its title and full text.
         """
-        Compute the BM25 relevance score for a given url with respect to the
-        tokens in query_tokens and the documents indexed in the InvertedIndex
-        index.
+        return sum(cursor.get_score() for cursor in cursors)
+
+    def _find_title_highlights(self, doc_id, tokens):
+        """
+        Return the sorted positions of the tokens in the title of doc_id, that
+        is the indexes of the words to highlight in its title.split(), as
+        found in the postings of the title index.
         """
-        # Some tweakable constants.
-        k1 = 1.2
-        BM25 = 0
+        title_index = self._index.get_title_index()
+        highlights = set()
+        for token in set(tokens):
+            highlights.update(title_index.get_match_positions_in_doc(doc_id, token))
+        return sorted(highlights)
+
+
+class _TermCursor(object):
+    """
+    Cursor on the posting list of a query token in a field of the index, used
+    by Searcher._find_top_documents().
 
-        for token in query_tokens:
-            n = index.get_matching_urls_count(token)
-            N = index.get_entry_count()
-            TF = index.get_match_count_in_url(url, token) # term frequency
-            self._logger.debug('n: ' + str(n))
-            self._logger.debug('N: ' + str(N))
-            self._logger.debug('TF: ' + str(TF))
+    weight is the weight of the token given by the scoring.FieldScorer of the
+    field, which also bounds the score the cursor can contribute to a
+    document.
+    """
+    __slots__ = ('upper_bound', '_field_scorer', '_weight', '_posting_list',
+                '_index', 'doc_id')
+
+    def __init__(self, field_scorer, posting_list, weight):
+        self.upper_bound = field_scorer.get_upper_bound(weight)
+        self._field_scorer = field_scorer
+        self._weight = weight
+        self._posting_list = posting_list
+        self._index = 0
+        self.doc_id = posting_list.doc_ids[0]
+
+    def get_score(self):
+        """Return the score of the token in the current document."""
+        offsets = self._posting_list.offsets
+        frequency = offsets[self._index + 1] - offsets[self._index]
+        return self._field_scorer.score(self._weight, frequency, self.doc_id)
+
+    def _move_to(self, index):
+        self._index = index
+        if index < len(self._posting_list.doc_ids):
+            self.doc_id = self._posting_list.doc_ids[index]
+        else:
+            self.doc_id = None
 
-            # Compute the relevance only of the token can be found in the url text.
-            if TF > 0:
-                IDF = math.log((N - n + 1.0) / n) / math.log(1.0 + N) # inverse document frequency
-                BM25 = BM25 + TF * IDF / (TF + k1)
+    def next(self):
+        """Move to the next document of the posting list."""
+        self._move_to(self._index + 1)
 
-        BM25 = 0.5 + BM25 / (2.0 * len(query_tokens))
-        return BM25
+    def advance(self, doc_id):
+        """Move to the first document whose id is at least doc_id."""
+        self._move_to(bisect_left(self._posting_list.doc_ids, doc_id, self._index))
+
+
+class SharedSearcher(object):
+    """
+    Process wide handle on a read only Searcher, meant to be shared by all the
+    request handlers of a server.
+
+    The index is loaded once, at the first query. Before each query, the
+    generation of the index file is checked and, if a newer index has been
+    dumped to the disk, a new Searcher is loaded and swapped in place of the
+    current one. Queries running during the reload keep using the previous
+    Searcher.
+
+    The answers of the last queries are kept in an LRU cache of
+    cache_size bytes, from which they expire after cache_ttl seconds, if it
+    is not None. The answers are cached by generation of the index and by
+    parsed query, so the queries analyzed to the same terms share their
+    answers, and the answers of the previous generations are dropped when a
+    new index is loaded.
+    """
+    # Default size in bytes of the answers cache.
+    CACHE_SIZE = 32 * 1024 * 1024
+    # Default time in seconds during which cached answers are served.
+    CACHE_TTL = 600
+
+    def __init__(self, index_filename=Index.FILENAME, cache_size=CACHE_SIZE,
+                cache_ttl=CACHE_TTL, **scoring_parameters):
+        self._logger = logging.getLogger(__name__)
+        self._index_filename = index_filename
+        self._scoring_parameters = scoring_parameters
+        self._searcher = None
+        # Only one thread at a time reloads the index.
+        self._reload_lock = threading.Lock()
+        self._cache = LRUCache(cache_size, cache_ttl)
+
+    def get(self):
+        """
+        Return the Searcher on the latest index available on the disk.
+        """
+        searcher = self._searcher
+        if searcher and searcher.get_generation() == get_index_generation(self._index_filename):
+            return searcher
+
+        # Only wait for the lock when no index has been loaded yet. Otherwise,
+        # while another thread loads the new index, keep answering with the
+        # previous Searcher.
+        if searcher:
+            if not self._reload_lock.acquire(False):
+                return searcher
+        else:
+            self._reload_lock.acquire()
+        try:
+            # Another thread may have reloaded the index while we were waiting
+            # for the lock.
+            searcher = self._searcher
+            if not searcher or searcher.get_generation() != get_index_generation(self._index_filename):
+                self._logger.info('Loading a new generation of the index from '
+                        '\'%s\'.' % self._index_filename)
+                searcher = Searcher(self._index_filename, **self._scoring_parameters)
+                # Assigning the reference is atomic, concurrent queries see
+                # either the old or the new Searcher.
+                self._searcher = searcher
+                self._cache.clear()
+        finally:
+            self._reload_lock.release()
+        return searcher
+
+    def load(self):
+        """
+        Load the index now if it exists, rather than at the first query, for
+        instance before forking processes which will share it.
+        """
+        if os.path.exists(self._index_filename):
+            self.get()
+
+    def get_generation(self):
+        """
+        Return the generation of the latest index on the disk, see
+        get_index_generation().
+        """
+        return get_index_generation(self._index_filename)
+
+    def query(self, query, limit=10, offset=0, snippets=True):
+        """See Searcher.query(), the answers being cached."""
+        searcher = self.get()
+        parsed_query = searcher.parse_query(query)
+        key = (searcher.get_generation(), parsed_query.get_key(), limit, offset,
+            snippets)
+        answers = self._cache.get(key)
+        if answers is None:
+            answers = searcher.run_query(parsed_query, limit, offset, snippets)
+            self._cache.put(key, answers, _get_answers_size(answers))
+        return answers
+
+    def get_stats(self):
+        """
+        Return the dict of the statistics of the answers cache and of the
+        current Searcher, if the index is loaded.
+        """
+        stats = {'answers_cache': self._cache.get_stats()}
+        searcher = self._searcher
+        if searcher:
+            stats.update(searcher.get_stats())
+        return stats
+
+
+def _get_answers_size(answers):
+    """
+    Return an estimate of the memory used by the list of Answer objects, in
+    bytes: the size of their strings and of their highlights, plus the
+    overhead of the objects.
+    """
+    size = 256
+    for answer in answers:
+        size += 512 + 4 * (len(answer.url) + len(answer.title or u'') +
+                        len(answer.snippet or u''))
+        size += 24 * (len(answer.title_highlights) + len(answer.snippet_highlights))
+        # The spans copy the title and the snippet.
+        size += 4 * (len(answer.title or u'') + len(answer.snippet or u''))
+        size += 128 * (len(answer.title_spans) + len(answer.snippet_spans))
+    return size
+
+
+def get_index_generation(index_filename):
+    """
+    Return an opaque value which changes each time a new index is dumped to
+    'index_filename', or None if there is no such file.
+
+    Index.dump() and segment.SegmentWriter rename a new file or directory over
+    'index_filename', so the inode number changes even when two dumps happen
+    within the mtime resolution.
+    """
+    try:
+        stat = os.stat(index_filename)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
 
 
 class Answer(object):
@@ -160,6 +481,10 @@ class Answer(object):
     integers containing which words to highlight in the title, a snippet of
     matching text and finally a list of integers containing which words to
     highlight in the snippet.
+
+    The title and the snippet are also split in spans, see get_spans(), so
+    that they are rendered with their highlights span by span rather than
+    word by word.
     """
     def __init__(self, url, score, title, title_highlights, snippet,
                 snippet_highlights):
@@ -167,6 +492,52 @@ class Answer(object):
         self.score = score
         self.title = title
         self.title_highlights = title_highlights
+        self.title_spans = get_spans(title, title_highlights)
         self.snippet = snippet
         self.snippet_highlights = snippet_highlights
+        self.snippet_spans = get_spans(snippet, snippet_highlights)
+
+    def to_json(self, fields=None):
+        """
+        Return the dict of the attributes of the Answer named in fields, all
+        of them if it is None.
+        """
+        return dict((field, getattr(self, field))
+                    for field in fields or ANSWER_FIELDS)
+
+
+# The attributes of an Answer.
+ANSWER_FIELDS = ('url', 'score', 'title', 'title_highlights', 'snippet',
+                'snippet_highlights')
+
+
+def get_spans(text, highlights):
+    """
+    Return the list of the (span, is_highlighted) tuples of the spans of the
+    words of text, the highlights being the positions of the highlighted
+    words. Each span is a run of consecutive words, all highlighted or all
+    not, joined by a space.
+    """
+    if not text:
+        return []
+    words = text.split()
+    spans = []
+    start = 0
+    end = 0
+    for position in sorted(highlights):
+        if position >= len(words):
+            break
+        if position < end:
+            continue
+        if position > end:
+            if end > start:
+                spans.append((u' '.join(words[start:end]), True))
+            spans.append((u' '.join(words[end:position]), False))
+            start = position
+        end = position + 1
+    if end > start:
+        spans.append((u' '.join(words[start:end]), True))
+    if end < len(words):
+        spans.append((u' '.join(words[end:]), False))
+    return spans
 
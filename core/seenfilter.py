@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+import anydbm
+import hashlib
+import logging
+import math
+import os
+import struct
+
+
+"""
+Module providing memory bounded sets of the urls already seen by the crawler.
+"""
+
+
+class BloomFilter(object):
+    """
+    Set of strings with a fixed capacity and false positive rate: once it
+    holds capacity keys, the probability that a key which was not added is
+    reported as present is about error_rate. A key which was added is always
+    reported as present.
+
+    The keys are hashed hash_count times into a bit array of bit_count bits,
+    using the double hashing of an md5 digest.
+    """
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.bit_count * math.log(2) / capacity)))
+        self.count = count
+        if bits is None:
+            bits = bytearray((self.bit_count + 7) // 8)
+        self.bits = bits
+
+    def _get_bit_indexes(self, key):
+        digest = hashlib.md5(key).digest()
+        first_hash, second_hash = struct.unpack('<QQ', digest)
+        for i in xrange(self.hash_count):
+            yield (first_hash + i * second_hash) % self.bit_count
+
+    def __contains__(self, key):
+        bits = self.bits
+        for index in self._get_bit_indexes(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """Add key, which must not be in the filter already."""
+        bits = self.bits
+        for index in self._get_bit_indexes(key):
+            bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+    """
+    Bloom filter growing with the number of keys while keeping the overall
+    false positive rate below error_rate.
+
+    When its last BloomFilter is full, a new one with twice the capacity and
+    half the false positive rate is added. The false positive rates of the
+    filters sum to less than error_rate.
+    """
+    MAGIC = 'BSBF'
+    HEADER = struct.Struct('<4sdI')
+    FILTER_HEADER = struct.Struct('<QdQ')
+
+    def __init__(self, initial_capacity=100000, error_rate=0.0001):
+        self._initial_capacity = initial_capacity
+        self._error_rate = error_rate
+        self._filters = []
+
+    def __len__(self):
+        return sum(bloom_filter.count for bloom_filter in self._filters)
+
+    def __contains__(self, key):
+        for bloom_filter in self._filters:
+            if key in bloom_filter:
+                return True
+        return False
+
+    def add(self, key):
+        """Add key, which must not be in the filter already."""
+        if not self._filters or self._filters[-1].is_full():
+            capacity = self._initial_capacity * 2 ** len(self._filters)
+            error_rate = self._error_rate / 2 ** (len(self._filters) + 1)
+            self._filters.append(BloomFilter(capacity, error_rate))
+        self._filters[-1].add(key)
+
+    def get_size(self):
+        """Return the size of the bit arrays, in bytes."""
+        return sum(len(bloom_filter.bits) for bloom_filter in self._filters)
+
+    def dump(self, filename):
+        """Write the filter to the binary file 'filename'."""
+        with open(filename, 'wb') as fp:
+            fp.write(ScalableBloomFilter.HEADER.pack(ScalableBloomFilter.MAGIC,
+                    self._error_rate, self._initial_capacity))
+            for bloom_filter in self._filters:
+                fp.write(ScalableBloomFilter.FILTER_HEADER.pack(bloom_filter.capacity,
+                        bloom_filter.error_rate, bloom_filter.count))
+                fp.write(bloom_filter.bits)
+
+    @staticmethod
+    def load(filename):
+        """Read back a filter written by dump() to 'filename'."""
+        with open(filename, 'rb') as fp:
+            magic, error_rate, initial_capacity = ScalableBloomFilter.HEADER.unpack(
+                    fp.read(ScalableBloomFilter.HEADER.size))
+            if magic != ScalableBloomFilter.MAGIC:
+                raise Exception('The file %s is not a bloom filter.' % filename)
+            scalable_filter = ScalableBloomFilter(initial_capacity, error_rate)
+            while True:
+                header = fp.read(ScalableBloomFilter.FILTER_HEADER.size)
+                if not header:
+                    break
+                capacity, error_rate, count = ScalableBloomFilter.FILTER_HEADER.unpack(header)
+                bloom_filter = BloomFilter(capacity, error_rate, count=count)
+                bloom_filter.bits = bytearray(fp.read(len(bloom_filter.bits)))
+                scalable_filter._filters.append(bloom_filter)
+        return scalable_filter
+
+
+class SeenUrls(object):
+    """
+    The set of the urls seen by the crawler, persisted to 'filename'.
+
+    The urls are kept in a ScalableBloomFilter, which needs a couple of bytes
+    per url whatever its length, but may report an url never seen as seen
+    with a probability of error_rate. If exact is True, the urls are also
+    stored in an on-disk hash table, 'filename'.db, which is only looked up
+    when the filter reports an url as seen, to rule out the false positives.
+    """
+    def __init__(self, filename, restart, error_rate=0.0001, exact=False):
+        """
+        Build an empty set of urls unless restart is True, in that case load
+        the set previously dumped to 'filename'.
+        """
+        self._logger = logging.getLogger(__name__)
+        self._filename = filename
+        if restart and os.path.exists(filename):
+            self._filter = ScalableBloomFilter.load(filename)
+        else:
+            self._filter = ScalableBloomFilter(error_rate=error_rate)
+        self._exact_urls = None
+        if exact:
+            self._exact_urls = anydbm.open(filename + '.db', 'c' if restart else 'n')
+
+    def __len__(self):
+        return len(self._filter)
+
+    def __contains__(self, url):
+        key = url.encode('utf-8')
+        if key not in self._filter:
+            return False
+        if self._exact_urls is not None:
+            return self._exact_urls.has_key(key)
+        return True
+
+    def add(self, url):
+        """Add url to the set. Return False if url was already in it."""
+        key = url.encode('utf-8')
+        if key in self._filter:
+            if self._exact_urls is None or self._exact_urls.has_key(key):
+                return False
+        else:
+            self._filter.add(key)
+        if self._exact_urls is not None:
+            self._exact_urls[key] = ''
+        return True
+
+    def dump(self):
+        """Write the set to its file."""
+        self._logger.info('Dumping the %d seen urls to \'%s\' (%d bytes).'
+                % (len(self), self._filename, self._filter.get_size()))
+        self._filter.dump(self._filename)
+        if self._exact_urls is not None:
+            self._exact_urls.sync()
@@ -0,0 +1,667 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+from analysis import Analyzer, SIMPLE_SETTINGS
+from array import array
+from cache import TinyLFUCache
+from docstore import DocumentStore, Words
+from index import Index, PostingList, extract_snippet
+from scoring import BM25Scorer, compute_norms
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+"""
+Module providing a compact binary, read only, on-disk format for the index.
+
+A segment is a directory containing the following files:
+    meta.json           Format version, document count, settings of the
+                        analysis.Analyzer and index statistics.
+    documents.idx       One '<QI' record per document id: offset and length of
+                        the document in documents.dat.
+    documents.dat       The documents (url, title, lengths and date) as utf-8
+                        json, one after the other.
+    texts.idx           One '<QI' record per document id: offset and length of
+                        the full text of the document in texts.dat.
+    texts.dat           The full texts of the documents, utf-8 encoded and
+                        zlib compressed one by one in a docstore.DocumentStore,
+                        so that they are only read and decompressed to make
+                        snippets. Before format version 2, they were not
+                        compressed.
+And for each field of the index ('title' and 'full_text'):
+    <field>.dict        The sorted term dictionary: one fixed size '<QIIQQ'
+                        record per term, holding the offset and length of the
+                        term in <field>.terms, the number of documents
+                        containing the term and the offsets of its postings in
+                        <field>.postings and <field>.positions.
+    <field>.terms       The utf-8 encoded terms, one after the other.
+    <field>.postings    For each term, the varint encoded (doc id delta, term
+                        frequency) pairs of the documents containing the term.
+    <field>.positions   For each posting, the varint encoded position deltas
+                        of the term in the document.
+    <field>.lengths     The length in tokens of the field of each document,
+                        as little endian 32 bits unsigned integers.
+    <field>.norms       NORMS_HEADER, the average length of the field and the
+                        k1 and b of the norms, then the BM25 norm of the field
+                        of each document, as little endian doubles. The
+                        segments written before the norms files compute the
+                        norms when they are opened.
+
+All the files are opened with mmap, so opening a segment does not read it and
+a searcher only touches the pages of the terms it looks up.
+"""
+
+
+FORMAT_VERSION = 2
+FIELDS = ('title', 'full_text')
+TERM_RECORD = struct.Struct('<QIIQQ')
+RECORD = struct.Struct('<QI')
+NORMS_HEADER = struct.Struct('<ddd')
+
+
+def encode_varint(value, buf):
+    """
+    Append the variable length encoding of the positive integer value to the
+    bytearray buf: 7 bits per byte, the high bit being set on all the bytes
+    but the last one.
+    """
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def decode_varints(data):
+    """Decode all the varints of the bytearray data and return them in a list."""
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+def _open_mmap(filename):
+    """
+    Map the file corresponding to filename in memory, read only. An empty file
+    cannot be mapped, an empty string is returned instead.
+    """
+    with open(filename, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _map_array(data, typecode, offset=0):
+    """
+    Return a read only sequence of the little endian numbers of struct format
+    typecode stored in data, a mmap, from offset, without copying them: a
+    NumPy array if NumPy is available, a _MappedArray otherwise.
+    """
+    if numpy is not None:
+        if len(data) <= offset:
+            return numpy.zeros(0, '<' + typecode)
+        return numpy.frombuffer(data, '<' + typecode, offset=offset)
+    return _MappedArray(data, typecode, offset)
+
+
+class _MappedArray(object):
+    """
+    Read only sequence of the little endian numbers of struct format typecode
+    stored in data, a mmap, from offset, each number being unpacked when it
+    is read.
+    """
+    def __init__(self, data, typecode, offset=0):
+        self._data = data
+        self._struct = struct.Struct('<' + typecode)
+        self._offset = offset
+        self._count = max(len(data) - offset, 0) // self._struct.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('_MappedArray index out of range')
+        return self._struct.unpack_from(self._data,
+                                        self._offset + index * self._struct.size)[0]
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+
+
+class FieldWriter(object):
+    """
+    Write the term dictionary and the postings of one field of a segment.
+
+    The terms must be added in their lexicographic order.
+    """
+    def __init__(self, dirname, field):
+        self._dirname = dirname
+        self._field = field
+        self._dict_fp = open(os.path.join(dirname, field + '.dict'), 'wb')
+        self._terms_fp = open(os.path.join(dirname, field + '.terms'), 'wb')
+        self._postings_fp = open(os.path.join(dirname, field + '.postings'), 'wb')
+        self._positions_fp = open(os.path.join(dirname, field + '.positions'), 'wb')
+        self._terms_offset = 0
+        self._postings_offset = 0
+        self._positions_offset = 0
+        self._last_term = None
+
+    def write_lengths(self, lengths, k1=BM25Scorer.K1, b=BM25Scorer.B):
+        """
+        Write the array('I') of the lengths of the field, by doc id, and the
+        BM25 norms of the field computed with k1 and b, so that they are not
+        computed when the segment is opened.
+        """
+        average_length = 0.0
+        if lengths:
+            average_length = float(sum(lengths)) / len(lengths)
+        norms = compute_norms(lengths, average_length, k1, b)
+        if sys.byteorder == 'big':
+            lengths = array('I', lengths)
+            lengths.byteswap()
+            norms.byteswap()
+        with open(os.path.join(self._dirname, self._field + '.lengths'), 'wb') as fp:
+            lengths.tofile(fp)
+        with open(os.path.join(self._dirname, self._field + '.norms'), 'wb') as fp:
+            fp.write(NORMS_HEADER.pack(average_length, k1, b))
+            norms.tofile(fp)
+
+    def add_term(self, term, postings):
+        """
+        Add a term and its postings, a list of (doc_id, positions) tuples
+        sorted by doc id.
+        """
+        encoded_term = term.encode('utf-8')
+        if self._last_term is not None and encoded_term <= self._last_term:
+            raise Exception('The terms must be added to a FieldWriter in '
+                            'lexicographic order.')
+        self._last_term = encoded_term
+
+        postings_buf = bytearray()
+        positions_buf = bytearray()
+        previous_doc_id = 0
+        for doc_id, positions in postings:
+            encode_varint(doc_id - previous_doc_id, postings_buf)
+            encode_varint(len(positions), postings_buf)
+            previous_doc_id = doc_id
+            previous_position = 0
+            for position in positions:
+                encode_varint(position - previous_position, positions_buf)
+                previous_position = position
+
+        self._dict_fp.write(TERM_RECORD.pack(self._terms_offset, len(encoded_term),
+                len(postings), self._postings_offset, self._positions_offset))
+        self._terms_fp.write(encoded_term)
+        self._postings_fp.write(postings_buf)
+        self._positions_fp.write(positions_buf)
+        self._terms_offset += len(encoded_term)
+        self._postings_offset += len(postings_buf)
+        self._positions_offset += len(positions_buf)
+
+    def close(self):
+        for fp in (self._dict_fp, self._terms_fp, self._postings_fp,
+                    self._positions_fp):
+            fp.close()
+
+
+class RecordsWriter(object):
+    """
+    Write variable length byte string records to a pair of 'name'.idx and
+    'name'.dat files, the record of index i being the i-th added one.
+    """
+    def __init__(self, dirname, name):
+        self._idx_fp = open(os.path.join(dirname, name + '.idx'), 'wb')
+        self._dat_fp = open(os.path.join(dirname, name + '.dat'), 'wb')
+        self._offset = 0
+
+    def add(self, data):
+        self._idx_fp.write(RECORD.pack(self._offset, len(data)))
+        self._dat_fp.write(data)
+        self._offset += len(data)
+
+    def close(self):
+        self._idx_fp.close()
+        self._dat_fp.close()
+
+
+class Records(object):
+    """Read only access to the records written by a RecordsWriter."""
+    def __init__(self, dirname, name):
+        self._idx = _open_mmap(os.path.join(dirname, name + '.idx'))
+        self._dat = _open_mmap(os.path.join(dirname, name + '.dat'))
+
+    def __len__(self):
+        return len(self._idx) // RECORD.size
+
+    def __getitem__(self, index):
+        offset, length = RECORD.unpack_from(self._idx, index * RECORD.size)
+        return self._dat[offset:offset + length]
+
+
+class SegmentWriter(object):
+    """
+    Write a segment to 'dirname'.
+
+    The segment is written to a temporary directory which replaces 'dirname'
+    when the writer is closed, so a segment being read is never modified.
+    Documents must be added in the order of their ids, starting from 0.
+    """
+    def __init__(self, dirname):
+        self._dirname = dirname
+        self._temporary_dirname = dirname + '.tmp'
+        if os.path.exists(self._temporary_dirname):
+            shutil.rmtree(self._temporary_dirname)
+        os.makedirs(self._temporary_dirname)
+        self._documents = RecordsWriter(self._temporary_dirname, 'documents')
+        self._texts = DocumentStore(os.path.join(self._temporary_dirname,
+                                                'texts.dat'))
+        self._texts_idx_fp = open(os.path.join(self._temporary_dirname,
+                                            'texts.idx'), 'wb')
+        self._document_count = 0
+
+    def add_document(self, document, full_text):
+        """
+        Add the next document, a json serializable dict with the 'url',
+        'title', 'date', 'title_length' and 'full_text_length' keys, and its
+        full text.
+        """
+        self._documents.add(json.dumps(document))
+        self._texts_idx_fp.write(RECORD.pack(*self._texts.add(full_text)))
+        self._document_count += 1
+
+    def make_field_writer(self, field):
+        return FieldWriter(self._temporary_dirname, field)
+
+    def close(self, meta):
+        """
+        Write the 'meta' dict of index statistics and move the segment in
+        place.
+        """
+        self._documents.close()
+        self._texts.close()
+        self._texts_idx_fp.close()
+        meta = dict(meta)
+        meta['format_version'] = FORMAT_VERSION
+        meta['document_count'] = self._document_count
+        with open(os.path.join(self._temporary_dirname, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+
+        # Rename the previous segment away before renaming the new one in
+        # place: a directory cannot be renamed over a non empty one.
+        if os.path.exists(self._dirname):
+            old_dirname = self._dirname + '.old'
+            if os.path.exists(old_dirname):
+                shutil.rmtree(old_dirname)
+            os.rename(self._dirname, old_dirname)
+            os.rename(self._temporary_dirname, self._dirname)
+            shutil.rmtree(old_dirname)
+        else:
+            os.rename(self._temporary_dirname, self._dirname)
+
+
+def write_index(index, dirname):
+    """
+    Write the index.Index 'index' as a segment in 'dirname'. The documents keep
+    their doc ids.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Writing the index segment \'%s\'.' % dirname)
+    writer = SegmentWriter(dirname)
+    for doc_id, url, url_info in index.iter_documents():
+        writer.add_document({'url': url,
+                'title': url_info['title'],
+                'date': url_info['date'],
+                'title_length': url_info['title_length'],
+                'full_text_length': url_info['full_text_length']},
+                index.get_full_text(doc_id))
+
+    for field, inverted_index in zip(FIELDS, (index.get_title_index(),
+                                                index.get_full_text_index())):
+        field_writer = writer.make_field_writer(field)
+        field_writer.write_lengths(inverted_index.get_lengths())
+        for term, posting_list in inverted_index.iter_terms():
+            if len(posting_list):
+                field_writer.add_term(term, list(posting_list.iter_postings()))
+        field_writer.close()
+
+    writer.close({'analyzer': index.get_analyzer().to_json(),
+            'average_title_length': index.get_average_title_length(),
+            'average_full_text_length': index.get_average_full_text_length()})
+    logger.info('A total of %d urls were written.' % index.get_indexed_url_count())
+
+
+def convert(json_filename, dirname):
+    """
+    Convert the json index dumped by Index.dump() to 'json_filename' to a
+    segment in 'dirname'.
+    """
+    index = Index(True, json_filename, read_only=True)
+    write_index(index, dirname)
+
+
+# Marks the terms which are not in the posting lists cache, None being cached
+# for the terms which are not in the segment.
+_MISSING = object()
+
+
+def _get_posting_list_size(posting_list):
+    """
+    Return an estimate of the memory used by the index.PostingList
+    posting_list, in bytes.
+    """
+    if posting_list is None:
+        return 64
+    item_size = posting_list.doc_ids.itemsize
+    return 256 + item_size * (len(posting_list.doc_ids) +
+            len(posting_list.offsets) + len(posting_list.positions))
+
+
+class Documents(object):
+    """Read only access to the documents of a segment."""
+    def __init__(self, dirname, format_version=FORMAT_VERSION):
+        self._documents = Records(dirname, 'documents')
+        self._texts = None
+        self._texts_idx = None
+        self._raw_texts = None
+        if format_version >= 2:
+            self._texts = DocumentStore(os.path.join(dirname, 'texts.dat'),
+                                        read_only=True)
+            self._texts_idx = _open_mmap(os.path.join(dirname, 'texts.idx'))
+        else:
+            self._raw_texts = Records(dirname, 'texts')
+        self._count = len(self._documents)
+
+    def get_count(self):
+        return self._count
+
+    def get(self, doc_id):
+        return json.loads(self._documents[doc_id])
+
+    def get_full_text(self, doc_id):
+        if self._raw_texts is not None:
+            return self._raw_texts[doc_id].decode('utf-8')
+        return self.get_words(doc_id).text
+
+    def get_words(self, doc_id):
+        """Return the docstore.Words of the full text of doc_id."""
+        if self._raw_texts is not None:
+            return Words(self._raw_texts[doc_id].decode('utf-8'))
+        return self._texts.get_words(*RECORD.unpack_from(self._texts_idx,
+                                                    doc_id * RECORD.size))
+
+    def get_url(self, doc_id):
+        return self.get(doc_id)['url']
+
+
+class SegmentInvertedIndex(object):
+    """
+    Read only InvertedIndex backed by one field of a segment.
+
+    It provides the same query methods as index.InvertedIndex.
+    """
+    def __init__(self, dirname, field, cache=None):
+        """
+        Open the field of the segment 'dirname'. The decoded posting lists are
+        kept in cache, a cache.LRUCache which may be shared by the fields, or
+        decoded at each lookup if it is None.
+        """
+        self._dict = _open_mmap(os.path.join(dirname, field + '.dict'))
+        self._terms = _open_mmap(os.path.join(dirname, field + '.terms'))
+        self._postings = _open_mmap(os.path.join(dirname, field + '.postings'))
+        self._positions = _open_mmap(os.path.join(dirname, field + '.positions'))
+        self._term_count = len(self._dict) // TERM_RECORD.size
+        # The runs of the builder have no lengths, they are mapped when they
+        # are first needed.
+        self._lengths_filename = os.path.join(dirname, field + '.lengths')
+        self._lengths = None
+        self._norms = None
+        norms_filename = os.path.join(dirname, field + '.norms')
+        if os.path.exists(norms_filename):
+            self._norms = _open_mmap(norms_filename)
+        self._field = field
+        self._cache = cache
+
+    def _get_record(self, index):
+        return TERM_RECORD.unpack_from(self._dict, index * TERM_RECORD.size)
+
+    def _find_term(self, token):
+        """
+        Binary search token in the term dictionary and return the index of its
+        record, or None if it is not in the dictionary.
+        """
+        encoded_token = token.encode('utf-8')
+        low = 0
+        high = self._term_count
+        while low < high:
+            middle = (low + high) // 2
+            term_offset, term_length = self._get_record(middle)[0:2]
+            term = self._terms[term_offset:term_offset + term_length]
+            if term < encoded_token:
+                low = middle + 1
+            elif term > encoded_token:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def get_posting_list(self, token):
+        """
+        Decode and return the index.PostingList of token or None if token is
+        not indexed.
+        """
+        key = (self._field, token)
+        if self._cache is not None:
+            posting_list = self._cache.get(key, _MISSING)
+            if posting_list is not _MISSING:
+                return posting_list
+
+        posting_list = None
+        index = self._find_term(token)
+        if index is not None:
+            posting_list = self._decode_posting_list(index)
+        if self._cache is not None:
+            self._cache.put(key, posting_list,
+                            _get_posting_list_size(posting_list))
+        return posting_list
+
+    def _decode_posting_list(self, index):
+        """Decode the index.PostingList of the term of record index."""
+        postings_offset, positions_offset = self._get_record(index)[3:5]
+        if index + 1 < self._term_count:
+            postings_end, positions_end = self._get_record(index + 1)[3:5]
+        else:
+            postings_end, positions_end = len(self._postings), len(self._positions)
+        values = decode_varints(bytearray(self._postings[postings_offset:postings_end]))
+        position_deltas = decode_varints(bytearray(self._positions[positions_offset:positions_end]))
+        posting_list = PostingList()
+        doc_id = 0
+        start = 0
+        for i in xrange(0, len(values), 2):
+            doc_id += values[i]
+            end = start + values[i + 1]
+            position = 0
+            for j in xrange(start, end):
+                position += position_deltas[j]
+                position_deltas[j] = position
+            posting_list.doc_ids.append(doc_id)
+            posting_list.offsets.append(end)
+            start = end
+        posting_list.positions = array('I', position_deltas)
+        return posting_list
+
+    def iter_terms(self):
+        """
+        Iterate on the (token, PostingList) pairs of the field in the
+        lexicographic order of the tokens, reading the files sequentially.
+        """
+        for index in xrange(self._term_count):
+            term_offset, term_length = self._get_record(index)[0:2]
+            term = self._terms[term_offset:term_offset + term_length].decode('utf-8')
+            yield term, self._decode_posting_list(index)
+
+    def get_entry_count(self):
+        return self._term_count
+
+    def get_lengths(self):
+        """
+        Return the read only sequence of the field lengths, by doc id, mapped
+        from the file.
+        """
+        if self._lengths is None:
+            self._lengths = _map_array(_open_mmap(self._lengths_filename), 'I')
+        return self._lengths
+
+    def get_average_length(self):
+        if self._norms is not None:
+            return NORMS_HEADER.unpack_from(self._norms)[0]
+        lengths = self.get_lengths()
+        if not len(lengths):
+            return 0.0
+        if numpy is not None:
+            return float(lengths.sum()) / len(lengths)
+        return float(sum(lengths)) / len(lengths)
+
+    def get_norms(self, k1, b):
+        """
+        Return the read only sequence of the BM25 norms of the field, by doc
+        id, see scoring.compute_norms(). The norms written with the segment
+        are mapped from the file if they were computed with the same k1 and
+        b, otherwise they are computed.
+        """
+        if (self._norms is not None and
+                NORMS_HEADER.unpack_from(self._norms)[1:] == (k1, b)):
+            return _map_array(self._norms, 'd', NORMS_HEADER.size)
+        return compute_norms(self.get_lengths(), self.get_average_length(), k1, b)
+
+    def get_matching_doc_ids(self, token):
+        """Return the sorted array of the ids of the documents containing token."""
+        posting_list = self.get_posting_list(token)
+        if posting_list is None:
+            return array('I')
+        return posting_list.doc_ids
+
+    def get_matching_doc_count(self, token):
+        index = self._find_term(token)
+        if index is None:
+            return 0
+        return self._get_record(index)[2]
+
+    def get_match_count_in_doc(self, doc_id, token):
+        posting_list = self.get_posting_list(token)
+        if posting_list is None:
+            return 0
+        return posting_list.get_count(doc_id)
+
+    def get_match_positions_in_doc(self, doc_id, token):
+        """
+        Return the array of matching positions of token in the document doc_id.
+        """
+        posting_list = self.get_posting_list(token)
+        if posting_list is None:
+            return array('I')
+        return posting_list.get_positions(doc_id)
+
+
+class SegmentIndex(object):
+    """
+    Read only Index backed by a segment written by write_index(), providing the
+    same query methods as index.Index.
+
+    The posting lists of the terms looked up are decoded from the files and
+    kept in a cache.TinyLFUCache of postings_cache_size bytes, so the
+    frequent terms of the queries are decoded once and the occasional ones
+    do not evict them.
+    """
+    # Default size in bytes of the decoded posting lists cache.
+    POSTINGS_CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, dirname, postings_cache_size=POSTINGS_CACHE_SIZE):
+        self._logger = logging.getLogger(__name__)
+        self._logger.info('Opening the index segment \'%s\'.' % dirname)
+        with open(os.path.join(dirname, 'meta.json')) as fp:
+            self._meta = json.load(fp)
+        if self._meta['format_version'] not in (1, FORMAT_VERSION):
+            raise Exception('Unsupported index segment format version %d in %s.'
+                            % (self._meta['format_version'], dirname))
+        # The segments written before the analyzers were introduced were
+        # analyzed like with the simple settings.
+        self._analyzer = Analyzer.from_json(self._meta.get('analyzer', SIMPLE_SETTINGS))
+        self._documents = Documents(dirname, self._meta['format_version'])
+        self._postings_cache = TinyLFUCache(postings_cache_size)
+        self._title_index = SegmentInvertedIndex(dirname, 'title',
+                                                self._postings_cache)
+        self._full_text_index = SegmentInvertedIndex(dirname, 'full_text',
+                                                    self._postings_cache)
+
+    def get_analyzer(self):
+        """Return the analysis.Analyzer of the queries."""
+        return self._analyzer
+
+    def get_title_index(self):
+        return self._title_index
+
+    def get_cache_stats(self):
+        """Return the dict of the statistics of the posting lists cache."""
+        return self._postings_cache.get_stats()
+
+    def get_full_text_index(self):
+        return self._full_text_index
+
+    def get_indexed_url_count(self):
+        return self._documents.get_count()
+
+    def get_average_title_length(self):
+        return self._meta['average_title_length']
+
+    def get_average_full_text_length(self):
+        return self._meta['average_full_text_length']
+
+    def get_url(self, doc_id):
+        return self._documents.get_url(doc_id)
+
+    def get_title(self, doc_id):
+        """Get the title of the page associated with doc_id."""
+        return self._documents.get(doc_id)['title']
+
+    def make_snippet(self, doc_id, tokens, context_before, context_after,
+                    max_match_count):
+        """See index.Index.make_snippet()."""
+        positions = []
+        for token in set(tokens):
+            positions += self._full_text_index.get_match_positions_in_doc(doc_id, token)
+        return extract_snippet(self._documents.get_words(doc_id), positions,
+                            context_before, context_after, max_match_count)
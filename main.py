@@ -32,7 +32,9 @@ def _search(args):
 
     # Get the answer of the searcher to this query.
     banana = Banana()
-    answers = banana.search(full_query)
+    if args.index:
+        banana.use_index(args.index)
+    answers = banana.search(full_query, args.limit, args.offset)
 
     # Print the answer to the user.
     print('\nBanana searched!\n\"%s\"?' % full_query)
@@ -48,14 +50,44 @@ def _crawl(args):
     Internal module level method directly called by the argparse argument parse.
     """
     banana = Banana()
-    banana.crawl(args.restart, args.seed)
+    banana.crawl(args.restart, args.seed, args.threads, args.timeout, args.delay,
+                args.seen_error_rate, args.exact_seen, args.processes)
 
 
 def _web_start(args):
     """
     Internal module level method directly called by the argparse argument parse.
     """
-    web.bananaweb.run_webapp()
+    Banana().use_index(args.index, args.cache_size * 1024 * 1024,
+                    args.cache_ttl)
+    host, port = _parse_bind(args.bind)
+    web.bananaweb.run_webapp(host, port, args.workers, args.threads)
+
+
+def _parse_bind(bind):
+    """Return the (host, port) tuple of the 'host:port' string bind."""
+    host, separator, port = bind.rpartition(':')
+    if not separator or not port.isdigit():
+        raise Exception('The address to bind \'%s\' is not of the form '
+                        'host:port.' % bind)
+    return host or 'localhost', int(port)
+
+
+def _convert(args):
+    """
+    Internal module level method directly called by the argparse argument parse.
+    """
+    banana = Banana()
+    banana.convert(args.input, args.output)
+
+
+def _reindex(args):
+    """
+    Internal module level method directly called by the argparse argument parse.
+    """
+    banana = Banana()
+    banana.reindex(args.input, args.output, args.processes, args.flush_count,
+                args.simple_analyzer)
 
 
 def main():
@@ -75,15 +107,82 @@ def main():
     parser_crawl.add_argument('-s', '--seed', type=str,
             help='The url from which the crawler will start, '
             'for instance http://myseedurl.org.')
+    parser_crawl.add_argument('-t', '--threads', type=int, default=8,
+            help='The number of pages fetched concurrently, 8 by default.')
+    parser_crawl.add_argument('--timeout', type=float, default=10,
+            help='The timeout in seconds of each page fetch, 10 by default.')
+    parser_crawl.add_argument('--delay', type=float, default=1,
+            help='The minimum delay in seconds between two fetches from the '
+            'same host, 1 by default.')
+    parser_crawl.add_argument('--seen-error-rate', type=float, default=0.0001,
+            help='The probability that an url never seen is skipped as already '
+            'seen, 0.0001 by default.')
+    parser_crawl.add_argument('--exact-seen', action='store_true',
+            help='Also store the seen urls exactly on the disk, so that no url '
+            'is wrongly skipped.')
+    parser_crawl.add_argument('-p', '--processes', type=int, default=0,
+            help='The number of processes parsing and tokenizing the pages in '
+            'parallel, 0 by default to parse them in the fetching threads.')
 
     # Create the parser for the 'search' command.
     parser_search = subparsers.add_parser('search', help='Search the web.')
     parser_search.set_defaults(function=_search)
     parser_search.add_argument('query', nargs='+', type=str, help='The search query.')
+    parser_search.add_argument('-l', '--limit', type=int, default=10,
+            help='The number of answers to show, 10 by default.')
+    parser_search.add_argument('-o', '--offset', type=int, default=0,
+            help='The number of best answers to skip, 0 by default.')
+    parser_search.add_argument('-i', '--index', type=str,
+            help='The json index file or index segment directory to search in, '
+            'index.json by default.')
 
     # Create the parser for the 'webstart' comand.
-    parser_web = subparsers.add_parser('webstart', help='Start the web interface of Banana, serving on localhost:8000.')
+    parser_web = subparsers.add_parser('webstart', help='Start the web interface of Banana, serving on localhost:8000 by default.')
     parser_web.set_defaults(function=_web_start)
+    parser_web.add_argument('-i', '--index', type=str,
+            help='The json index file or index segment directory to search in, '
+            'index.json by default.')
+    parser_web.add_argument('--cache-size', type=int, default=32,
+            help='The size in megabytes of the cache of the answers to the '
+            'last queries, 32 by default.')
+    parser_web.add_argument('--cache-ttl', type=float, default=600,
+            help='The time in seconds during which a cached answer is served, '
+            '600 by default.')
+    parser_web.add_argument('-b', '--bind', type=str, default='localhost:8000',
+            help='The host:port address to serve on, localhost:8000 by default.')
+    parser_web.add_argument('-w', '--workers', type=int, default=1,
+            help='The number of processes serving the requests, 1 by default.')
+    parser_web.add_argument('-t', '--threads', type=int, default=8,
+            help='The number of threads serving the requests in each process, '
+            '8 by default.')
+
+    # Create the parser for the 'convert' command.
+    parser_convert = subparsers.add_parser('convert',
+            help='Convert a json index to a binary index segment directory.')
+    parser_convert.set_defaults(function=_convert)
+    parser_convert.add_argument('-i', '--input', type=str, default='index.json',
+            help='The json index to convert, index.json by default.')
+    parser_convert.add_argument('-o', '--output', type=str, default='index.seg',
+            help='The segment directory to write, index.seg by default.')
+
+    # Create the parser for the 'reindex' command.
+    parser_reindex = subparsers.add_parser('reindex',
+            help='Index again the stored pages in a binary index segment '
+            'directory, with several processes.')
+    parser_reindex.set_defaults(function=_reindex)
+    parser_reindex.add_argument('-i', '--input', type=str, default='index.json',
+            help='The json index, index log (.log) or segment directory holding '
+            'the pages to index, index.json by default.')
+    parser_reindex.add_argument('-o', '--output', type=str, default='index.seg',
+            help='The segment directory to write, index.seg by default.')
+    parser_reindex.add_argument('-p', '--processes', type=int,
+            help='The number of indexing processes, one per core by default.')
+    parser_reindex.add_argument('--flush-count', type=int, default=2000000,
+            help='The number of token occurrences each process indexes in memory '
+            'before writing them to the disk, 2000000 by default.')
+    parser_reindex.add_argument('--simple-analyzer', action='store_true',
+            help='Only strip the stop words from the words, without folding '
+            'their accents nor stemming them.')
 
     # Really parse the script arguments.
     args = parser.parse_args()
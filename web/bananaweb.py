@@ -16,14 +16,42 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with banana.  If not, see <http://www.gnu.org/licenses/>.
 from core.banana import Banana
-from bottle import run, debug, request, route, view, static_file
+from core.searcher import ANSWER_FIELDS
+from bottle import Bottle, SimpleTemplate, html_escape, request, response
+from bottle import static_file
+import hashlib
+import json
 import logging
+import os
+import re
+import wsgiserver
+import zlib
 
 
-def run_webapp():
+# The directory of the templates and static files of the web interface, so
+# that the application works whatever the current directory.
+WEB_DIRNAME = os.path.dirname(os.path.abspath(__file__))
+# Maximum number of answers of a page of the search API.
+MAX_LIMIT = 100
+# The characters escaped in html.
+HTML_SPECIAL_CHARS_PATTERN = re.compile(u'[&<>"\']')
 
-    @route('/', method='GET')
-    @view('search_template')
+
+def make_app():
+    """
+    Return the WSGI application of the web interface, searching with the
+    Banana singleton.
+    """
+    app = Bottle()
+    log = logging.getLogger(__name__)
+    search_template = SimpleTemplate(name='search_template',
+                                    lookup=[os.path.join(WEB_DIRNAME, 'views')],
+                                    escape_func=_escape_html)
+    # Render the page without answers once, which compiles the template, so
+    # that it is compiled here rather than at the first search.
+    search_template.render(answers=[])
+
+    @app.route('/', method='GET')
     def search_page():
         """Main search page."""
         query = request.GET.get('query', '').strip()
@@ -34,16 +62,143 @@ def run_webapp():
         if query:
             banana = Banana()
             answers = banana.search(query)
-        return dict(answers=answers)
+        return search_template.render(answers=answers)
+
+    @app.route('/api/search', method='GET')
+    def search_api():
+        """
+        Search API, returning the page of the answers to the query q of rank
+        offset to offset + limit as json. fields is the comma separated list
+        of the attributes of the answers to return, all of them by default,
+        the snippets being made only if asked for.
+
+        The response is streamed, compressed with gzip if the client accepts
+        it. Its ETag is made from the generation of the index and the
+        parameters, so that a client asking again for a page gets a 304 Not
+        Modified response until a new index is dumped.
+        """
+        try:
+            query = request.GET.get('q', '').strip().decode('utf-8')
+            limit = int(request.GET.get('limit', 10))
+            offset = int(request.GET.get('offset', 0))
+            fields = ANSWER_FIELDS
+            if request.GET.get('fields'):
+                fields = tuple(request.GET.get('fields').split(','))
+        except ValueError as e:
+            return _make_error(str(e))
+        if not query:
+            return _make_error('The query q is empty.')
+        if not 0 < limit <= MAX_LIMIT or offset < 0:
+            return _make_error('The limit must be between 1 and %d, and the '
+                            'offset positive.' % MAX_LIMIT)
+        unknown_fields = set(fields) - set(ANSWER_FIELDS)
+        if unknown_fields:
+            return _make_error('Unknown fields: %s.' % ', '.join(unknown_fields))
+
+        banana = Banana()
+        etag = _make_etag(banana.get_index_generation(), query, limit, offset,
+                        fields)
+        response.set_header('ETag', etag)
+        response.set_header('Vary', 'Accept-Encoding')
+        if _is_matching(request.get_header('If-None-Match', ''), etag):
+            response.status = 304
+            return ''
+
+        log.info('API query: ' + query)
+        snippets = 'snippet' in fields or 'snippet_highlights' in fields
+        answers = banana.search(query, limit, offset, snippets)
+        response.content_type = 'application/json'
+        chunks = _iter_json(query, limit, offset, answers, fields)
+        if 'gzip' in request.get_header('Accept-Encoding', ''):
+            response.set_header('Content-Encoding', 'gzip')
+            chunks = _compress(chunks)
+        return chunks
 
-    @route('/static/<filepath:path>')
+    @app.route('/stats', method='GET')
+    def stats_page():
+        """Statistics of the searches, such as the hits of the caches."""
+        return Banana().get_search_stats()
+
+    @app.route('/static/<filepath:path>')
     def server_static(filepath):
         """Serve static files (css for instance)."""
         log.info(filepath)
-        return static_file(filepath, root='./static')
+        return static_file(filepath, root=os.path.join(WEB_DIRNAME, 'static'))
 
-    log = logging.getLogger(__name__)
-    debug(True)
-    run(host='localhost', port=8000, reloader=True)
-    # run(host='localhost', port=8000)
+    return app
+
+
+def _escape_html(text):
+    """
+    Same as bottle.html_escape(), returning text itself when there is nothing
+    to escape, as for most of the spans of the answers.
+    """
+    if HTML_SPECIAL_CHARS_PATTERN.search(text) is None:
+        return text
+    return html_escape(text)
+
+
+def _make_error(message):
+    """Return the response of the search API to a bad request."""
+    response.status = 400
+    return {'error': message}
+
+
+def _make_etag(generation, query, limit, offset, fields):
+    """
+    Return the weak ETag of the response of the search API to the query
+    parameters, for the index generation.
+    """
+    key = (generation, query, limit, offset, tuple(sorted(set(fields))))
+    return 'W/"%s"' % hashlib.md5(repr(key)).hexdigest()
+
+
+def _is_matching(if_none_match, etag):
+    """
+    Return True if etag is one of the ETags of the If-None-Match header value
+    if_none_match.
+    """
+    etags = [value.strip() for value in if_none_match.split(',')]
+    # The weak and strong versions of an ETag match.
+    return '*' in etags or etag in etags or etag[2:] in etags
+
+
+def _iter_json(query, limit, offset, answers, fields):
+    """
+    Iterate on the chunks of the json response of the search API, one per
+    answer, of which only fields are returned.
+    """
+    yield json.dumps({'query': query, 'limit': limit, 'offset': offset})[:-1]
+    yield ', "answers": ['
+    for position, answer in enumerate(answers):
+        if position:
+            yield ', '
+        yield json.dumps(answer.to_json(fields))
+    yield ']}'
+
+
+def _compress(chunks):
+    """Iterate on the chunks of the gzip compression of the chunks."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# The WSGI application, which may also be served by any WSGI server.
+application = make_app()
+
+
+def run_webapp(host='localhost', port=8000, worker_count=1,
+            thread_count=wsgiserver.ThreadPoolWSGIServer.THREAD_COUNT):
+    """
+    Serve the web interface on host:port with worker_count processes of
+    thread_count threads, see wsgiserver.serve().
 
+    The index is loaded before the processes are forked, so that they share
+    its memory.
+    """
+    Banana().load_index()
+    wsgiserver.serve(application, host, port, worker_count, thread_count)
@@ -37,11 +37,11 @@
         <header>
         <h3 class="result-title">
             <a href="{{answer.url}}" rel="result-link" title="Link to the result url">
-            %for position, word in enumerate(answer.title.split()):
-                %if position in answer.title_highlights:
-                    <em>{{word}}</em>
+            %for span, is_highlighted in answer.title_spans:
+                %if is_highlighted:
+                    <em>{{span}}</em>
                 %else:
-                    {{word}}
+                    {{span}}
                 %end
             %end
             </a>
@@ -55,11 +55,11 @@
 
         <div class="result-snippet">
         <p>
-        %for position, word in enumerate(answer.snippet.split()):
-            %if position in answer.snippet_highlights:
-                <strong>{{word}}</strong>
+        %for span, is_highlighted in answer.snippet_spans:
+            %if is_highlighted:
+                <strong>{{span}}</strong>
             %else:
-                {{word}}
+                {{span}}
             %end
         %end
         </p>
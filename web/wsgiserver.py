@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# Copyright 2012 Florent Galland
+#
+# This file is part of banana.
+#
+# banana is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+# banana is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with banana.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import os
+import Queue
+import signal
+import threading
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+
+"""
+Module providing the WSGI server of the web interface: a pool of processes
+forked after the index is loaded, each serving the requests with a pool of
+threads.
+"""
+
+
+class _RequestHandler(WSGIRequestHandler):
+    """WSGIRequestHandler logging the requests with the logging module."""
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug('%s %s' % (self.client_address[0],
+                                                    format % args))
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """
+    WSGIServer handling the requests in thread_count threads, so that a slow
+    request does not delay the others.
+
+    The connections are accepted by the thread calling serve_forever() and
+    queued to the threads, at most thread_count of them waiting. Once all the
+    threads are busy, the connections are left to the other processes
+    accepting on the same socket, if any.
+    """
+    # Default number of threads handling the requests.
+    THREAD_COUNT = 8
+
+    def __init__(self, server_address, thread_count=THREAD_COUNT):
+        WSGIServer.__init__(self, server_address, _RequestHandler)
+        self._thread_count = thread_count
+        self._requests = Queue.Queue(thread_count)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Start the threads and handle the requests until shutdown(). The
+        threads are started here rather than in the constructor so that they
+        run in the process serving, which may have been forked since.
+        """
+        for _ in xrange(self._thread_count):
+            thread = threading.Thread(target=self._handle_requests)
+            thread.daemon = True
+            thread.start()
+        WSGIServer.serve_forever(self, poll_interval)
+
+    def get_request(self):
+        request, client_address = WSGIServer.get_request(self)
+        # The listening socket is non blocking, and on BSD and Mac OS X the
+        # accepted sockets inherit this flag, which the handlers do not
+        # expect.
+        request.setblocking(1)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _handle_requests(self):
+        """Handle the requests queued by process_request(), forever."""
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                # Even a SystemExit must not stop the thread.
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def serve(app, host='localhost', port=8000, worker_count=1,
+        thread_count=ThreadPoolWSGIServer.THREAD_COUNT):
+    """
+    Serve the WSGI application app on host:port, until interrupted.
+
+    The socket is bound, then worker_count processes are forked, each
+    accepting the connections on it and handling them in thread_count
+    threads. The memory of the process, such as a loaded index, is shared by
+    the workers until they modify it. A worker which dies is replaced.
+    Without os.fork(), or if worker_count is 1, the requests are served by
+    this process only.
+    """
+    logger = logging.getLogger(__name__)
+    server = ThreadPoolWSGIServer((host, port), thread_count)
+    server.set_app(app)
+    logger.info('Serving on http://%s:%d/ with %d processes of %d threads.' %
+                (host, port, worker_count, thread_count))
+    if worker_count <= 1 or not hasattr(os, 'fork'):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    # Each worker waits for the connections with select() and they all wake up
+    # at each one, the non blocking socket lets the workers which lose the
+    # race go back to waiting.
+    server.socket.setblocking(0)
+    workers = set()
+    try:
+        while True:
+            while len(workers) < worker_count:
+                pid = os.fork()
+                if pid == 0:
+                    _run_worker(server)
+                workers.add(pid)
+            pid, status = os.wait()
+            workers.discard(pid)
+            logger.warning('Worker %d exited with status %d, starting a new '
+                        'one.' % (pid, status))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        server.server_close()
+
+
+def _run_worker(server):
+    """Serve with server in a forked worker process, and exit it."""
+    status = 1
+    try:
+        server.serve_forever()
+        status = 0
+    except KeyboardInterrupt:
+        status = 0
+    except Exception:
+        logging.getLogger(__name__).exception('Worker %d failed.' % os.getpid())
+    finally:
+        os._exit(status)